@@ -0,0 +1,156 @@
+# asyncio counterparts of blocking utils functions (requires python 3.6+)
+import asyncio
+import functools
+import threading
+import concurrent.futures
+import numpy as np
+import utils
+
+# default number of worker threads used for blocking calls
+_MAX_WORKERS = 4
+_executor = None
+_executor_lock = threading.Lock()
+
+# loop of the running coroutine (get_running_loop is new in python 3.7)
+_get_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+def get_executor(max_workers=None):
+    ''' return shared bounded executor used for blocking calls
+
+        Parameters:
+        max_workers - int, number of worker threads if creating the executor
+            [default is None, sets to 4]
+
+        Returns:
+        executor - concurrent.futures.ThreadPoolExecutor, shared executor
+            (created on first call)
+    '''
+    global _executor
+    with _executor_lock:
+        if _executor == None:
+            if max_workers == None:
+                max_workers = _MAX_WORKERS
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+    return _executor
+
+async def _run(fun, executor=None, limit=None):
+    ''' run fun in executor, waiting for limit (asyncio.Semaphore) if given '''
+    if executor == None:
+        executor = get_executor()
+    loop = _get_loop()
+    if limit == None:
+        return await loop.run_in_executor(executor, fun)
+    async with limit:
+        return await loop.run_in_executor(executor, fun)
+
+def _next_batch(it, lock, n):
+    ''' return next n items of iterator (fewer if exhausted) '''
+    with lock:
+        batch = []
+        for item in it:
+            batch.append(item)
+            if len(batch) == n:
+                break
+        return batch
+
+def _close(it, lock):
+    ''' close generator once any step in progress has finished '''
+    with lock:
+        it.close()
+
+async def async_pebl_search(folder, expr, ftype, n_levels=np.inf,
+                            verbose=False, n_jobs=1, use_processes=False,
+                            scan='read', max_size=None, skip_binary=False,
+                            cache=None, executor=None, limit=None,
+                            batch_size=16):
+    ''' search a folder, subfolders, and files for expr without blocking the
+        event loop, yielding matches as they are found
+
+        Parameters:
+        folder, expr, ftype, n_levels, verbose, n_jobs, use_processes, scan,
+        max_size, skip_binary, cache - see utils.pebl_search
+        executor - concurrent.futures.Executor, executor used to walk folders
+            and search files
+            [default is None, uses get_executor()]
+        limit - asyncio.Semaphore, semaphore held while each batch of results
+            is searched (shared between calls to limit concurrent searches)
+            [default is None]
+        batch_size - int, number of results searched per executor call
+            [default is 16]
+
+        Returns:
+        async generator, yields fullpath files that contained expression in
+            name or text (in the same order as pebl_search)
+
+        Example:
+        async def main():
+            limit = asyncio.Semaphore(8)
+            async for filename in async_pebl_search('/study/sub01', 'rp_.*',
+                                                    'dir', limit=limit):
+                print(filename)
+        asyncio.run(main())
+
+        Note: The search stops when the generator is closed or the task is
+        cancelled (the batch in progress is finished in the executor first).
+    '''
+    it = utils.iter_search(folder, expr, ftype, n_levels, verbose, n_jobs,
+                           use_processes, scan, max_size, skip_binary, cache)
+    lock = threading.Lock()
+    if executor == None:
+        executor = get_executor()
+    try:
+        while True:
+            batch = await _run(functools.partial(_next_batch, it, lock,
+                batch_size), executor, limit)
+            for filename in batch:
+                yield filename
+            if len(batch) < batch_size:
+                break
+    finally:
+        # stop walk without waiting on the event loop
+        executor.submit(_close, it, lock)
+
+async def async_py2mat(A, filename, variable, do_compression=False,
+                       lazy=False, executor=None, limit=None):
+    ''' load from or save to matlab format without blocking the event loop
+
+        Parameters:
+        A, filename, variable, do_compression, lazy - see utils.py2mat
+        executor - concurrent.futures.Executor, executor used to load or save
+            [default is None, uses get_executor()]
+        limit - asyncio.Semaphore, semaphore held while loading or saving
+            [default is None]
+
+        Returns:
+        A - object, object converted from file or converted to matlab format
+
+        Example:
+        async def main(files):
+            limit = asyncio.Semaphore(4)
+            return await asyncio.gather(*[async_py2mat(None, f, 'matlabbatch',
+                limit=limit) for f in files])
+    '''
+    return await _run(functools.partial(utils.py2mat, A, filename, variable,
+        do_compression, lazy), executor, limit)
+
+async def async_pebl_search_all(folders, expr, ftype, max_concurrency=4,
+                                **kwargs):
+    ''' search several folders concurrently
+
+        Parameters:
+        folders - list, folders to search
+        expr, ftype - see utils.pebl_search
+        max_concurrency - int, number of folders searched at once (each
+            folder is walked entirely before another folder is started)
+            [default is 4]
+        kwargs - other options passed to async_pebl_search
+
+        Returns:
+        files - list, list of matching files for each folder in folders
+    '''
+    limit = asyncio.Semaphore(max_concurrency)
+    async def _search(folder):
+        async with limit:
+            return [f async for f in async_pebl_search(folder, expr, ftype,
+                **kwargs)]
+    return await asyncio.gather(*[_search(f) for f in folders])
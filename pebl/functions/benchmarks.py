@@ -0,0 +1,343 @@
+import os
+import sys
+import shutil
+import tempfile
+import platform
+import json
+import time
+import gc
+import functools
+import numpy as np
+import utils
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# default sizes used for each benchmark sweep
+_SIZES = [10, 100, 1000]
+
+# (depth, width) of deep and wide batches (same number of leaves as the
+# default 4 x 4 batch)
+_SHAPES = {'deep': (8, 2), 'wide': (2, 16)}
+
+# monotonic high-resolution clock (perf_counter is new in python 3.3)
+_clock = getattr(time, 'perf_counter', time.time)
+
+def gen_batch(n_modules, depth=4, width=4):
+    ''' generate a synthetic SPM-style batch
+
+        Parameters:
+        n_modules - int, number of modules in batch
+        depth - int, number of nested fields within each module
+            [default is 4]
+        width - int, number of fields at each level
+            [default is 4]
+
+        Returns:
+        A - list, batch of modules (i.e. A[0]['spm']['util']...)
+
+        Example:
+        A = gen_batch(1, depth=2, width=2)
+        A =
+        [{'spm': {'field0': {'field0': {'data': '<UNDEFINED>', ...
+    '''
+    def _level(d):
+        if d == 0:
+            return {'data': '<UNDEFINED>', 'n': d, 'so': list(range(width))}
+        return dict([('field%d' % n, _level(d - 1)) for n in range(width)])
+    return [{'spm': _level(depth)} for _ in range(n_modules)]
+
+def gen_celltable(n_rows, n_cols=5):
+    ''' generate a synthetic cell table of mixed str/number values
+
+        Parameters:
+        n_rows - int, number of rows
+        n_cols - int, number of columns
+            [default is 5]
+
+        Returns:
+        celltable - ndarray, object array with shape (n_rows, n_cols)
+    '''
+    celltable = np.empty((n_rows, n_cols), dtype=np.object)
+    for r in range(n_rows):
+        for c in range(n_cols):
+            if c % 2 == 0:
+                celltable[r, c] = 'subj%d_col%d' % (r, c)
+            else:
+                celltable[r, c] = r * n_cols + c
+    return celltable
+
+def gen_tree(folder, n_files, depth=3, width=3, expr='spm_jobman'):
+    ''' generate a synthetic directory tree of text files
+
+        Parameters:
+        folder - str, folder in which to create the tree
+        n_files - int, number of files to create
+        depth - int, number of nested folders
+            [default is 3]
+        width - int, number of subfolders at each level
+            [default is 3]
+        expr - str, text written to every tenth file (to be searched for)
+            [default is 'spm_jobman']
+
+        Returns:
+        files - list, fullpath files created
+    '''
+    # create folders
+    folders = [folder]
+    level = [folder]
+    for _ in range(depth):
+        level = [os.path.join(f, 'dir%d' % n) for f in level
+                 for n in range(width)]
+        folders.extend(level)
+    for f in folders:
+        if not os.path.isdir(f):
+            os.makedirs(f)
+    # create files across folders
+    files = []
+    for n in range(n_files):
+        filename = os.path.join(folders[n % len(folders)], 'file%d.m' % n)
+        with open(filename, 'w') as f:
+            f.write('%% synthetic file %d\n' % n)
+            f.write(('x = %d;\n' % n) * 20)
+            if n % 10 == 0:
+                f.write(expr + '(\'run\', matlabbatch);\n')
+        files.append(filename)
+    return files
+
+def measure(fun, args=(), n_repeats=3):
+    ''' measure time and peak memory of fun(*args)
+
+        Parameters:
+        fun - function, function to measure
+        args - tuple, arguments to fun
+            [default is ()]
+        n_repeats - int, number of times to time fun
+            [default is 3]
+
+        Returns:
+        result - dict, 'time' (minimum seconds), 'mean' (mean seconds), and
+            'peak' (peak bytes allocated during one call, or None if
+            tracemalloc is unavailable)
+
+        Note: Peak memory is measured in a separate call from timing, since
+        tracing allocations slows each call.
+    '''
+    times = []
+    for _ in range(n_repeats):
+        gc.collect()
+        t0 = _clock()
+        fun(*args)
+        times.append(_clock() - t0)
+    # measure peak memory
+    peak = None
+    if tracemalloc != None:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            fun(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {'time': min(times), 'mean': np.mean(times), 'peak': peak}
+
+def _setup_batch(n, depth=4, width=4):
+    return (gen_batch(n, depth, width),)
+
+def _setup_getfield(n, depth=4, width=4):
+    return (gen_batch(n, depth, width), None, None, '.*\["data"\]$')
+
+def _setup_setfield(n, depth=4, width=4):
+    A = gen_batch(n, depth, width)
+    S = [[i, 'spm'] + ['field0'] * depth + ['data'] for i in range(n)]
+    return (A, './a.nii', S)
+
+def _setup_subsref(n, depth=4, width=4):
+    return (gen_batch(n, depth, width), [n - 1, 'spm'] +
+        ['field%d' % (d % width) for d in range(depth)] + ['data'])
+
+def _setup_subsasgn(n, depth=4, width=4):
+    return _setup_subsref(n, depth, width) + ('./a.nii',)
+
+def _py2mat_roundtrip(A):
+    f = tempfile.NamedTemporaryFile(suffix='.mat', delete=False)
+    f.close()
+    try:
+        utils.py2mat(A, f.name, 'matlabbatch')
+        utils.py2mat(None, f.name, 'matlabbatch')
+    finally:
+        os.remove(f.name)
+
+def _setup_search(n):
+    folder = tempfile.mkdtemp()
+    gen_tree(folder, n)
+    return (folder, 'spm_jobman', '.*\.m$')
+
+# benchmarks as name: (setup function returning args, function)
+benchmarks = {
+    'subsref': (_setup_subsref, utils.subsref),
+    'subsasgn': (_setup_subsasgn, utils.subsasgn),
+    'struct2sub': (_setup_batch, utils.struct2sub),
+    'pebl_getfield': (_setup_getfield, utils.pebl_getfield),
+    'pebl_setfield': (_setup_setfield,
+        lambda A, C, S: utils.pebl_setfield(A, C, S=S)),
+    'py2mat': (_setup_batch, _py2mat_roundtrip),
+    'cell2strtable': (lambda n: (gen_celltable(n * 10),),
+        utils.cell2strtable),
+    'pebl_search': (_setup_search, utils.pebl_search),
+}
+
+# default sizes of benchmarks much slower or faster than others
+_benchmark_sizes = {
+    'pebl_getfield': [1, 10, 100],
+    'py2mat': [1, 10, 100],
+    'cell2strtable': [100, 1000, 10000],
+    'pebl_search': [100, 1000, 10000],
+}
+
+def _add_shapes(names):
+    ''' add deep and wide batch benchmarks (e.g., 'subsref_deep') for each
+        batch benchmark in names
+    '''
+    for name in names:
+        setup, fun = benchmarks[name]
+        for shape, (depth, width) in _SHAPES.items():
+            shape_name = '{0}_{1}'.format(name, shape)
+            benchmarks[shape_name] = (functools.partial(setup, depth=depth,
+                width=width), fun)
+            if name in _benchmark_sizes:
+                _benchmark_sizes[shape_name] = _benchmark_sizes[name]
+
+_add_shapes(['subsref', 'subsasgn', 'struct2sub', 'pebl_getfield',
+             'pebl_setfield', 'py2mat'])
+
+def run_benchmarks(names=None, sizes=None, n_repeats=3, filename=None,
+                   verbose=False):
+    ''' run benchmarks across a sweep of input sizes
+
+        Parameters:
+        names - list, names of benchmarks to run (see benchmarks)
+            [default is None, runs all benchmarks]
+        sizes - list, input sizes to run each benchmark
+            [default is None, sets to [10, 100, 1000] (or smaller or larger
+            sizes for benchmarks that are much slower or faster)]
+        n_repeats - int, number of times to time each benchmark/size
+            [default is 3]
+        filename - str, json file to save results
+            [default is None]
+        verbose - bool, print each benchmark/size result
+            [default is False]
+
+        Returns:
+        results - dict, 'info' (python/numpy versions, platform, clock, and
+            time) and 'results' (dict of name: list of dicts with 'size',
+            'time', 'mean', and 'peak')
+
+        Example:
+        results = run_benchmarks(['subsref'], sizes=[10, 100])
+        results['results'] =
+        {'subsref': [{'size': 10, 'time': 2.1e-05, 'mean': 2.5e-05,
+        'peak': 1392}, {'size': 100, 'time': 2.0e-05, ...}]}
+    '''
+    if names == None:
+        names = sorted(benchmarks.keys())
+    results = {'info': {'python': sys.version.split()[0],
+                        'numpy': np.__version__,
+                        'platform': platform.platform(),
+                        'clock': _clock.__name__,
+                        'time': time.strftime('%Y-%m-%d %H:%M:%S')},
+               'results': {}}
+    for name in names:
+        setup, fun = benchmarks[name]
+        results['results'][name] = []
+        if sizes == None:
+            sizes_ = _benchmark_sizes.get(name, _SIZES)
+        else:
+            sizes_ = sizes
+        for n in sizes_:
+            args = setup(n)
+            try:
+                result = measure(fun, args, n_repeats)
+            finally:
+                # remove synthetic directory tree
+                if name == 'pebl_search':
+                    shutil.rmtree(args[0])
+            result['size'] = n
+            results['results'][name].append(result)
+            if verbose:
+                print('{0} (size {1}): {2:.6f} s, peak {3} bytes'.format(
+                    name, n, result['time'], result['peak']))
+    # save results
+    if filename != None:
+        with open(filename, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return results
+
+def compare_benchmarks(filename0, filename1, threshold=0.1, verbose=True):
+    ''' compare two benchmark result files
+
+        Parameters:
+        filename0 - str or dict, baseline results (json filename or results
+            from run_benchmarks)
+        filename1 - str or dict, new results to compare against baseline
+        threshold - float, relative increase in time or peak memory reported
+            as a regression
+            [default is 0.1]
+        verbose - bool, print table of comparisons
+            [default is True]
+
+        Returns:
+        regressions - list, (name, size, measure, ratio) for each benchmark
+            that is slower or uses more memory than threshold allows
+
+        Example:
+        regressions = compare_benchmarks('old.json', 'new.json')
+        name          size    time0       time1       ratio   peak ratio
+        subsref       10      0.000021    0.000022    1.048   1.000
+        ...
+        regressions =
+        [('py2mat', 1000, 'time', 1.52)]
+    '''
+    # load results
+    results = []
+    for r in [filename0, filename1]:
+        if isinstance(r, str):
+            with open(r, 'r') as f:
+                r = json.load(f)
+        results.append(r['results'])
+    # compare each benchmark/size in both results
+    table = [['name', 'size', 'time0', 'time1', 'ratio', 'peak ratio']]
+    regressions = []
+    for name in sorted(set(results[0]).intersection(results[1])):
+        new = dict([(r['size'], r) for r in results[1][name]])
+        for r0 in results[0][name]:
+            if r0['size'] not in new:
+                continue
+            r1 = new[r0['size']]
+            ratio = {'time': None, 'peak': None}
+            for k in ratio.keys():
+                if r0[k] and r1[k] != None:
+                    ratio[k] = float(r1[k]) / r0[k]
+                    if ratio[k] > 1. + threshold:
+                        regressions.append((name, r0['size'], k, ratio[k]))
+            table.append([name, r0['size'], '%.6f' % r0['time'],
+                '%.6f' % r1['time'], '%.3f' % ratio['time'] if ratio['time']
+                else '-', '%.3f' % ratio['peak'] if ratio['peak'] else '-'])
+    if verbose:
+        print(utils.cell2strtable(table))
+    return regressions
+
+if __name__ == '__main__':
+    # python benchmarks.py results.json
+    # python benchmarks.py old.json new.json
+    if len(sys.argv) == 3:
+        regressions = compare_benchmarks(sys.argv[1], sys.argv[2])
+        for name, n, k, ratio in regressions:
+            print('regression: {0} (size {1}) {2} x{3:.3f}'.format(name, n, k,
+                ratio))
+        sys.exit(len(regressions) > 0)
+    elif len(sys.argv) == 2:
+        run_benchmarks(filename=sys.argv[1], verbose=True)
+    else:
+        print('usage: python benchmarks.py results.json [new_results.json]')
@@ -0,0 +1,127 @@
+# regression tests for async_utils (python 3 only; python -m pytest
+# test_async_utils.py or python -m unittest test_async_utils)
+import os
+import shutil
+import asyncio
+import tempfile
+import threading
+import unittest
+import concurrent.futures
+import utils
+import async_utils
+
+def run(coro):
+    ''' run coroutine in a new event loop '''
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+async def collect(gen):
+    return [item async for item in gen]
+
+class AsyncSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.folders = []
+        for n in range(3):
+            folder = os.path.join(self.folder, 'sub%d' % n)
+            os.makedirs(os.path.join(folder, 'deep'))
+            for m in range(5):
+                for name in ['a%d.txt' % m,
+                             os.path.join('deep', 'b%d.txt' % m)]:
+                    with open(os.path.join(folder, name), 'w') as f:
+                        f.write('rp_%d\n' % (m % 2))
+            self.folders.append(folder)
+        self.executor = concurrent.futures.ThreadPoolExecutor(4)
+        self.iter_search = utils.iter_search
+        self.active = []
+        self.closed = []
+
+    def tearDown(self):
+        utils.iter_search = self.iter_search
+        self.executor.shutdown(wait=True)
+        shutil.rmtree(self.folder)
+
+    def track(self, event=None, n_wait=None):
+        ''' record walks in progress (optionally waiting for event after
+            n_wait results)
+        '''
+        active = set()
+        def iter_search(folder, *args):
+            active.add(folder)
+            self.active.append(len(active))
+            try:
+                for n, filename in enumerate(self.iter_search(folder, *args)):
+                    if n == n_wait:
+                        event.wait()
+                    yield filename
+            finally:
+                active.discard(folder)
+                self.closed.append(folder)
+        utils.iter_search = iter_search
+
+    def test_search(self):
+        # results match pebl_search in order
+        for ftype, expr in [('dir', '.*\\.txt$'), ('.*\\.txt$', 'rp_1')]:
+            expected = utils.pebl_search(self.folder, expr, ftype)
+            self.assertTrue(len(expected) > 0)
+            for batch_size in [1, 4, 100]:
+                files = run(collect(async_utils.async_pebl_search(
+                    self.folder, expr, ftype, executor=self.executor,
+                    batch_size=batch_size)))
+                self.assertEqual(files, expected, (expr, batch_size))
+
+    def test_search_all(self):
+        # each folder is walked entirely while holding the limit
+        self.track()
+        expected = [utils.pebl_search(f, 'rp_1', '.*\\.txt$')
+                    for f in self.folders]
+        for max_concurrency in [1, 2]:
+            del self.active[:]
+            files = run(async_utils.async_pebl_search_all(self.folders,
+                'rp_1', '.*\\.txt$', max_concurrency, executor=self.executor,
+                batch_size=1))
+            self.assertEqual(files, expected)
+            self.assertEqual(max(self.active), max_concurrency)
+
+    def test_cancel(self):
+        # cancelling the task mid-walk closes the walk
+        event = threading.Event()
+        self.track(event, 2)
+        files = []
+        async def search():
+            async for filename in async_utils.async_pebl_search(self.folder,
+                '.*\\.txt$', 'dir', executor=self.executor, batch_size=1):
+                files.append(filename)
+        async def main():
+            task = asyncio.ensure_future(search())
+            while len(files) < 2:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        run(main())
+        event.set()
+        self.executor.shutdown(wait=True)
+        self.assertEqual(self.closed, [self.folder])
+        self.assertEqual(len(files), 2)
+
+class AsyncPy2matTest(unittest.TestCase):
+    def test_py2mat(self):
+        folder = tempfile.mkdtemp()
+        try:
+            files = [os.path.join(folder, '%d.mat' % n) for n in range(4)]
+            async def main():
+                limit = asyncio.Semaphore(2)
+                await asyncio.gather(*[async_utils.async_py2mat({'n': n}, f,
+                    'A', limit=limit) for n, f in enumerate(files)])
+                return await asyncio.gather(*[async_utils.async_py2mat(None,
+                    f, 'A', limit=limit) for f in files])
+            self.assertEqual(run(main()), [{'n': n} for n in range(4)])
+        finally:
+            shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,725 @@
+# regression tests for utils (python -m pytest test_utils.py or
+# python -m unittest test_utils)
+import os
+import re
+import copy
+import random
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import utils
+
+def gen_value(rng, depth=0):
+    ''' generate a random nested dict/list/ndarray structure '''
+    c = rng.random()
+    if depth > 3 or c < 0.3:
+        return rng.choice([1, 'x', 2.5, [], {}, np.zeros(0), (1,)])
+    if c < 0.55:
+        return dict([(rng.choice('abcde'), gen_value(rng, depth + 1))
+                     for _ in range(rng.randint(0, 3))])
+    if c < 0.8:
+        return [gen_value(rng, depth + 1) for _ in range(rng.randint(0, 3))]
+    if c < 0.9:
+        return np.arange(rng.randint(0, 4))
+    value = np.empty(2, dtype=object)
+    value[0] = gen_value(rng, depth + 1)
+    value[1] = 'y'
+    return value
+
+def gen_paths(rng, A, n):
+    ''' return n random substructs of A (some extended past its leaves) '''
+    paths = utils.struct2sub(A)
+    S = []
+    for _ in range(n):
+        S_ = list(rng.choice(paths))
+        if rng.random() < 0.5 and len(S_) > 0:
+            S_ = S_[:rng.randint(0, len(S_))]
+        if rng.random() < 0.5:
+            S_ = S_ + [rng.choice(['a', 'z', 0, 2])]
+        S.append(S_)
+    return S
+
+def set_each(A, S, C):
+    ''' set each value in C at each substruct in S one at a time '''
+    A = copy.deepcopy(A)
+    for S_, C_ in zip(S, C):
+        A = utils.subsasgn(A, S_, copy.deepcopy(C_), copy_mode='none')
+    return A
+
+def failed_write(A, S, C):
+    ''' return (index, error) of the first value in set_each that cannot be
+        set, or (None, None)
+    '''
+    A = copy.deepcopy(A)
+    for i, (S_, C_) in enumerate(zip(S, C)):
+        try:
+            A = utils.subsasgn(A, S_, copy.deepcopy(C_), copy_mode='none')
+        except Exception as e:
+            return i, e
+    return None, None
+
+class SubsTest(unittest.TestCase):
+    def test_subsref(self):
+        A = {0: {'test': [9, 8, 7]}, 'a': np.arange(5)}
+        self.assertEqual(utils.subsref(A, [0, 'test', 1]), 8)
+        self.assertEqual(utils.subsref(A, ['a', '1:3']).tolist(), [1, 2])
+        value = utils.subsref(A, [0, 'test'], 'none')
+        self.assertTrue(value is A[0]['test'])
+        self.assertFalse(utils.subsref(A, [0, 'test']) is A[0]['test'])
+
+    def test_subsasgn(self):
+        A = {0: {'spm': {'util': {'disp': {'data': '<UNDEFINED>'}}}}}
+        S = [0, 'spm', 'util', 'disp', 'data']
+        B = utils.subsasgn(A, S, './a.nii')
+        self.assertEqual(B[0]['spm']['util']['disp']['data'], './a.nii')
+        self.assertEqual(A[0]['spm']['util']['disp']['data'], '<UNDEFINED>')
+        # grow lists and add fields
+        self.assertEqual(utils.subsasgn([1], [2], 3), [1, [], 3])
+        self.assertEqual(utils.subsasgn({}, ['a', 'b'], 1), {'a': {'b': 1}})
+        self.assertEqual(utils.subsasgn(A, [], 1), 1)
+
+    def test_copy_mode(self):
+        A = {'a': {'b': [1, 2]}, 'c': {'d': 1}}
+        B = utils.subsasgn(A, ['a', 'b', 0], 3, copy_mode='path')
+        self.assertEqual(A['a']['b'], [1, 2])
+        self.assertEqual(B['a']['b'], [3, 2])
+        self.assertTrue(B['c'] is A['c'])
+        B = utils.subsasgn(A, ['a', 'b', 0], 3, copy_mode='deep')
+        self.assertFalse(B['c'] is A['c'])
+        B = utils.subsasgn(A, ['a', 'b', 0], 3, copy_mode='none')
+        self.assertTrue(B is A)
+        self.assertEqual(A['a']['b'], [3, 2])
+        self.assertRaises(ValueError, utils.subsasgn, A, ['a'], 1, None, 'x')
+
+    def test_array_element(self):
+        # elements of numeric ndarrays cannot be indexed
+        A = {'a': np.arange(4)}
+        for copy_mode in ['deep', 'path', 'none']:
+            self.assertRaises(TypeError, utils.subsasgn, A, ['a', 1, 0], 5,
+                None, copy_mode)
+        self.assertEqual(A['a'].tolist(), [0, 1, 2, 3])
+        B = utils.subsasgn(A, ['a', 1], 5)
+        self.assertEqual(B['a'].tolist(), [0, 5, 2, 3])
+
+class SetfieldTest(unittest.TestCase):
+    def test_example(self):
+        A = {0: {'spm': {'util': {'disp': {'data': '<UNDEFINED>'}}}}}
+        R = '[0]["spm"]["util"]["disp"]["data"]'
+        B = utils.pebl_setfield(A, './a.nii', R=R)
+        self.assertEqual(utils.pebl_getfield(B, R=R)[0], ['./a.nii'])
+        self.assertEqual(A[0]['spm']['util']['disp']['data'], '<UNDEFINED>')
+
+    def test_order(self):
+        # later values take precedence at the same substruct or within it
+        A = {'a': {'b': 1}}
+        B = utils.pebl_setfield(A, [2, 3], S=[['a', 'b'], ['a', 'b']])
+        self.assertEqual(B, {'a': {'b': 3}})
+        B = utils.pebl_setfield(A, [2, {'c': 1}], S=[['a', 'b'], ['a']])
+        self.assertEqual(B, {'a': {'c': 1}})
+        B = utils.pebl_setfield(A, [{'c': 1}, 2], S=[['a'], ['a', 'd']])
+        self.assertEqual(B, {'a': {'c': 1, 'd': 2}})
+        # root type changes between writes
+        B = utils.pebl_setfield([1], [2, 3], S=[[0], ['a']])
+        self.assertEqual(B, set_each([1], [[0], ['a']], [2, 3]))
+        B = utils.pebl_setfield({0: 1}, [2, 3], S=[['a'], [1]])
+        self.assertEqual(B, {0: 1, 'a': 2, 1: 3})
+
+    def test_array_element(self):
+        # elements of numeric ndarrays cannot be indexed
+        A = {'a': np.arange(4)}
+        for copy_mode in ['deep', 'path', 'none']:
+            self.assertRaises(TypeError, utils.pebl_setfield, A, 5,
+                S=['a', 1, 0], copy_mode=copy_mode)
+            self.assertRaises(TypeError, utils.pebl_setfield, A, [1, 5],
+                S=[['b'], ['a', 1, 0]], copy_mode=copy_mode)
+        self.assertEqual(A['a'].tolist(), [0, 1, 2, 3])
+
+    def test_random(self):
+        rng = random.Random(0)
+        n = 0
+        while n < 300:
+            A = gen_value(rng)
+            S = gen_paths(rng, A, rng.randint(1, 5))
+            C = [rng.choice([1, 2.5, {'q': [1, 2]}]) for _ in S]
+            i, error = failed_write(A, S, C)
+            if i != None:
+                # values that cannot be set (e.g., within an element of a
+                # numeric ndarray) fail unless replaced by a later value
+                if isinstance(error, TypeError) and len(S[i]) > 0 and \
+                    not any([S[i][:len(S_)] == S_ for S_ in S[i + 1:]]):
+                    self.assertRaises(TypeError, utils.pebl_setfield, A, C,
+                        S=S)
+                continue
+            expected = set_each(A, S, C)
+            A0 = repr(A)
+            for copy_mode in ['deep', 'path']:
+                B = utils.pebl_setfield(A, C, S=S, copy_mode=copy_mode)
+                self.assertEqual(repr(B), repr(expected), (A, S, C))
+                self.assertEqual(repr(A), A0)
+            B = utils.pebl_setfield(copy.deepcopy(A), C, S=S,
+                copy_mode='none')
+            self.assertEqual(repr(B), repr(expected), (A, S, C))
+            n += 1
+
+    def test_persistent(self):
+        A = utils.PersistentStruct({'a': {'b': 1}, 'c': {'d': 2}})
+        B = utils.pebl_setfield(A, 3, S=['a', 'b'])
+        self.assertEqual(B.thaw(), {'a': {'b': 3}, 'c': {'d': 2}})
+        self.assertEqual(A.thaw(), {'a': {'b': 1}, 'c': {'d': 2}})
+        self.assertTrue(A.A['c'] is B.A['c'])
+
+class GetfieldFunTest(unittest.TestCase):
+    def check_fun(self, A, fun):
+        # batched evaluation matches evaluating one value at a time
+        batched = utils.pebl_getfield(A, fun=fun)
+        each = utils.pebl_getfield(A, fun=dict(fun, vectorize=False))
+        self.assertEqual(batched[1], each[1], fun)
+        self.assertEqual(batched[2], each[2], fun)
+        self.assertEqual([repr(C_) for C_ in batched[0]],
+            [repr(C_) for C_ in each[0]])
+        return batched
+
+    def test_vectorize(self):
+        A = {'a': [1, 2.5, True, False, np.float32(2.0), np.int64(3), 2,
+                   np.uint8(2), 2 + 0j, np.bool_(True), 1.9999999999],
+             'b': {'c': 2.0, 'd': np.arange(3), 'e': [2, [2.0, 3]]}}
+        for fun in [{'fun': np.equal, 1: 2}, {'fun': np.greater, 1: 1},
+                    {'fun': np.less_equal, 0: 2.0},
+                    {'fun': np.isclose, 1: 2.0},
+                    {'fun': np.isclose, 0: 2, 'rtol': 0}]:
+            self.check_fun(A, fun)
+        C, _, R = self.check_fun(A, {'fun': np.isclose, 1: 2.0})
+        self.assertEqual(R, ['["a"][4]', '["a"][6]', '["a"][7]', '["a"][8]',
+            '["a"][10]', '["b"]["c"]', '["b"]["d"][2]', '["b"]["e"][0]',
+            '["b"]["e"][1][0]'])
+
+    def test_mixed(self):
+        # non-numeric values are evaluated one at a time in both modes
+        A = {'a': [1, 'x', 2.5, True, None], 'b': 'y'}
+        for fun in [{'fun': np.equal, 1: 2}, {'fun': np.isclose, 1: 2.0}]:
+            errors = []
+            for vectorize in [None, False]:
+                try:
+                    utils.pebl_getfield(A, fun=dict(fun, vectorize=vectorize))
+                except Exception as e:
+                    errors.append(type(e))
+            self.assertEqual(len(errors), 2)
+            self.assertEqual(errors[0], errors[1])
+        # a python function handles every type
+        fun = {'fun': lambda x: isinstance(x, (int, float)) and x > 1,
+               'vectorize': True}
+        C, _, R = self.check_fun(A, fun)
+        self.assertEqual(R, ['["a"][2]'])
+
+class PathIndexTest(unittest.TestCase):
+    def test_example(self):
+        A = {0: {'spm': {'util': {'disp': {'data': '<UNDEFINED>'}}}}}
+        index = utils.PathIndex(A)
+        C, S, R = utils.pebl_getfield(index, expr='.*\\["disp"\\]')
+        self.assertEqual(R, ['[0]["spm"]["util"]["disp"]'])
+        R = '[0]["spm"]["util"]["disp"]["data"]'
+        index = utils.pebl_setfield(index, './a.nii', R=R)
+        self.assertEqual(index.get(R)[1], './a.nii')
+        self.assertTrue(index.A is A)
+
+    def test_setfield(self):
+        # updated index matches an index built from the updated object
+        rng = random.Random(3)
+        n = 0
+        while n < 300:
+            A = gen_value(rng)
+            r = rng.choice([np.inf, 1, 2])
+            S = gen_paths(rng, A, rng.randint(1, 4))
+            C = [rng.choice([1, 'v', {'q': [1, 2]}]) for _ in S]
+            if failed_write(A, S, C)[0] != None:
+                continue
+            index = utils.PathIndex(copy.deepcopy(A), r)
+            index = utils.pebl_setfield(index, C, S=S)
+            fresh = utils.PathIndex(index.A, r)
+            self.assertEqual(index.S, fresh.S, (A, r, S, C))
+            self.assertEqual(index.R, fresh.R, (A, r, S, C))
+            self.assertEqual([repr(C_) for C_ in index.C],
+                [repr(C_) for C_ in fresh.C])
+            n += 1
+
+class PathPatternTest(unittest.TestCase):
+    def test_find(self):
+        A = {0: {'spm': {'util': {'disp': {'data': '<UNDEFINED>'}}}},
+             1: {'spm': {'spatial': {'realign': {'data': []}}}}}
+        pattern = utils.PathPattern('[*]["spm"][**]["data"]')
+        self.assertEqual([S for S, _ in pattern.find(A)],
+            [[0, 'spm', 'util', 'disp', 'data'],
+             [1, 'spm', 'spatial', 'realign', 'data']])
+        self.assertTrue(pattern.match([1, 'spm', 'data']))
+
+    def test_negative_index(self):
+        pattern = utils.PathPattern('[-1]')
+        self.assertEqual(list(pattern.find([1, 2, 3])), [([2], 3)])
+        pattern = utils.PathPattern('["a"][-1]')
+        self.assertEqual(list(pattern.find({'a': [1, 2, 3]})),
+            [(['a', 2], 3)])
+        # dict keys are not resolved
+        self.assertEqual(list(pattern.find({'a': {2: 1, -1: 0}})),
+            [(['a', -1], 0)])
+
+class CompilePatternTest(unittest.TestCase):
+    def test_name_matcher(self):
+        # fast suffix matching agrees with re.match
+        rng = random.Random(7)
+        expr = ['.*\\.nii$', '.*rp_a\\.txt$', '.*\\$\\.\\(x\\)$', '.*$',
+                '.*\\\\a$', '.*a\\.nii\\?$', 'a.*\\.nii$', '.*\\.ni+$',
+                re.compile('.*\\.nii$'), re.compile('.*\\.nii$', re.I)]
+        chars = ['a', '.', 'nii', 'NII', 'rp_', 'txt', '\n', '$', '(x)', '\\',
+                 '?']
+        for _ in range(2000):
+            name = ''.join([rng.choice(chars)
+                            for _ in range(rng.randint(0, 6))])
+            for e in expr:
+                self.assertEqual(utils._name_matcher(e)(name),
+                    utils.compile_pattern(e).match(name) != None, (e, name))
+        # flags of compiled patterns are kept
+        self.assertTrue(utils._name_matcher(expr[-1])('A.NII'))
+        self.assertFalse(utils._name_matcher(expr[-2])('A.NII'))
+        self.assertTrue(utils._name_matcher(expr[0])('a.nii\n'))
+
+    def test_cache(self):
+        # least recently used patterns are removed first
+        size = utils._pattern_cache_size
+        cache = utils._pattern_cache.copy()
+        try:
+            utils.set_pattern_cache_size(0)
+            utils.set_pattern_cache_size(2)
+            a = utils.compile_pattern('a')
+            utils.compile_pattern('b')
+            self.assertTrue(utils.compile_pattern('a') is a)
+            utils.compile_pattern('c')
+            keys = [k[1] for k in utils._pattern_cache]
+            self.assertEqual(keys, ['a', 'c'])
+            # flags and bytes are cached separately
+            self.assertEqual(utils.compile_pattern('a', re.I).flags & re.I,
+                re.I)
+            utils.compile_pattern(b'c')
+            self.assertEqual([k[1:] for k in utils._pattern_cache],
+                [('a', re.I), (b'c', 0)])
+            utils.set_pattern_cache_size(1)
+            self.assertEqual(len(utils._pattern_cache), 1)
+            utils.set_pattern_cache_size(0)
+            utils.compile_pattern('d')
+            self.assertEqual(len(utils._pattern_cache), 0)
+        finally:
+            utils.set_pattern_cache_size(size)
+            utils._pattern_cache.update(cache)
+
+class SearchTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        files = {'a.py': 'def foo():\n    import os\n',
+                 'b.py': 'import os\nimport sys\n',
+                 'anat.nii': 'NII',
+                 os.path.join('sub', 'c.py'): 'x = 1\n' + 'y' * 10000 +
+                     '\ndef bar():\n    pass\n',
+                 os.path.join('sub', 'a.txt'): 'def foo',
+                 os.path.join('sub', 'deep', 'd.py'): 'import re\n'}
+        for name, text in files.items():
+            filename = os.path.join(self.folder, name)
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(filename, 'w') as f:
+                f.write(text)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def search(self, expr, ftype, **kwargs):
+        files = utils.pebl_search(self.folder, expr, ftype, **kwargs)
+        if type(files) == dict:
+            return dict([(e, sorted(files[e])) for e in files])
+        return sorted(files)
+
+    def test_combine(self):
+        # backreferences and global flags are searched separately
+        self.assertEqual(utils._combine(['(a)\\1', 'b']), None)
+        self.assertEqual(utils._combine(['a', '(?i)b']), None)
+        self.assertNotEqual(utils._combine(['(?i:a)', 'b']), None)
+        rng = random.Random(5)
+        expr = ['(a)\\1', '(?i)B', 'ab', 'b+a', '(?P<x>c)(?P=x)', 'd']
+        for _ in range(200):
+            txt = ''.join([rng.choice('abcdB') for _ in range(6)])
+            expr_ = rng.sample(expr, rng.randint(1, len(expr)))
+            expected = [n for n, e in enumerate(expr_)
+                        if re.search(e, txt) != None]
+            self.assertEqual(utils._search_each(expr_, txt), expected,
+                (expr_, txt))
+            pattern = utils._combine(expr_, True)
+            expected = [n for n, e in enumerate(expr_)
+                        if re.match(e, txt) != None]
+            self.assertEqual(utils._match_each(expr_, pattern, txt),
+                expected, (expr_, txt))
+
+    def test_multi(self):
+        # names matching several expressions are returned for each
+        expr = ['.*\\.py$', 'a.*', '.*\\.nii$']
+        files = self.search(expr, 'dir', group=True)
+        self.assertEqual(files, dict([(e, self.search(e, 'dir'))
+                                      for e in expr]))
+        self.assertEqual(len(files['a.*']), 3)
+        self.assertEqual(self.search(expr, 'dir'),
+            sorted(set(sum(files.values(), []))))
+        # text of each file is searched once for all expressions
+        expr = ['def \\w+', 'import os', '(i)mport \\1?re', 'pass$']
+        for scan in ['read', 'chunk']:
+            files = self.search(expr, '.*\\.py$', group=True, scan=scan)
+            self.assertEqual(files, dict([(e, self.search(e, '.*\\.py$'))
+                                          for e in expr]), scan)
+            self.assertEqual(self.search(expr, '.*\\.py$', scan=scan),
+                sorted(set(sum(files.values(), []))))
+        self.assertEqual(files['def \\w+'],
+            [os.path.join(self.folder, 'a.py'),
+             os.path.join(self.folder, 'sub', 'c.py')])
+
+    def test_jobs(self):
+        # workers return the same files in the same order
+        for expr in ['import (os|re)', ['def \\w+', 'import os']]:
+            expected = utils.pebl_search(self.folder, expr, '.*\\.py$')
+            self.assertTrue(len(expected) > 1)
+            for n_jobs in [2, -1]:
+                for use_processes in [False, True]:
+                    files = utils.pebl_search(self.folder, expr, '.*\\.py$',
+                        n_jobs=n_jobs, use_processes=use_processes)
+                    self.assertEqual(files, expected,
+                        (expr, n_jobs, use_processes))
+
+    def test_scan(self):
+        # mmap and chunk scans find the same files as reading each file
+        rng = random.Random(11)
+        folder = os.path.join(self.folder, 'rand')
+        os.mkdir(folder)
+        for n in range(40):
+            with open(os.path.join(folder, '%d.txt' % n), 'w') as f:
+                f.write(''.join([rng.choice('ab\n')
+                                 for _ in range(rng.randint(0, 40))]))
+        chunk = (utils._CHUNK_SIZE, utils._CHUNK_OVERLAP)
+        utils._CHUNK_SIZE, utils._CHUNK_OVERLAP = 8, 4
+        try:
+            for _ in range(40):
+                # short expressions (anchors must not match at overlaps)
+                expr = [''.join([rng.choice('ab\n')
+                                 for _ in range(rng.randint(1, 4))])
+                        for _ in range(3)]
+                expr[rng.randint(0, 2)] = rng.choice(['^a', '^b', '(?m)^b',
+                    '\\Ab', 'bb\\n'])
+                for e in [expr[0], expr]:
+                    expected = utils.pebl_search(folder, e, '.*\\.txt$',
+                        group=True)
+                    for scan in ['mmap', 'chunk']:
+                        files = utils.pebl_search(folder, e, '.*\\.txt$',
+                            scan=scan, group=True)
+                        self.assertEqual(files, expected, (e, scan))
+        finally:
+            utils._CHUNK_SIZE, utils._CHUNK_OVERLAP = chunk
+
+    def test_skip(self):
+        with open(os.path.join(self.folder, 'e.py'), 'w') as f:
+            f.write('import os\x00')
+        expected = self.search('import os', '.*\\.py$')
+        self.assertEqual(len(expected), 3)
+        for scan in ['read', 'mmap', 'chunk']:
+            files = self.search('import os', '.*\\.py$', scan=scan,
+                skip_binary=True)
+            self.assertEqual(files, expected[:2], scan)
+            # skip files larger than max_size bytes
+            for max_size in [0, 10, 22, 1000]:
+                files = self.search('import os', '.*\\.py$', scan=scan,
+                    max_size=max_size)
+                self.assertEqual(files, [f for f in expected
+                    if os.path.getsize(f) <= max_size], (scan, max_size))
+
+    def test_cache(self):
+        # cached listings and results are reused until files change
+        cache = utils.SearchCache()
+        expected = self.search('import os', '.*\\.py$')
+        files = self.search('import os', '.*\\.py$', cache=cache)
+        self.assertEqual(files, expected)
+        self.assertEqual(cache.counts, {'dir_hits': 0, 'dir_misses': 3,
+            'file_hits': 0, 'file_misses': 4})
+        cache.reset_counts()
+        files = self.search('import os', '.*\\.py$', cache=cache)
+        self.assertEqual(files, expected)
+        self.assertEqual(cache.counts, {'dir_hits': 3, 'dir_misses': 0,
+            'file_hits': 4, 'file_misses': 0})
+        # results for other options are cached separately
+        cache.reset_counts()
+        self.search('import os', '.*\\.py$', cache=cache, scan='mmap')
+        self.assertEqual(cache.counts['file_misses'], 4)
+        # changed files and folders are searched again
+        filename = os.path.join(self.folder, 'b.py')
+        with open(filename, 'w') as f:
+            f.write('import sys\n')
+        st = os.stat(filename)
+        os.utime(filename, (st.st_atime, st.st_mtime + 10))
+        subfolder = os.path.join(self.folder, 'sub')
+        with open(os.path.join(subfolder, 'e.py'), 'w') as f:
+            f.write('import os\n')
+        st = os.stat(subfolder)
+        os.utime(subfolder, (st.st_atime, st.st_mtime + 10))
+        cache.reset_counts()
+        expected = self.search('import os', '.*\\.py$')
+        files = self.search('import os', '.*\\.py$', cache=cache)
+        self.assertEqual(files, expected)
+        self.assertEqual(files, [os.path.join(self.folder, 'a.py'),
+                                 os.path.join(subfolder, 'e.py')])
+        self.assertEqual(cache.counts, {'dir_hits': 2, 'dir_misses': 1,
+            'file_hits': 3, 'file_misses': 2})
+        # invalidated folders are listed and searched again
+        cache.invalidate(subfolder)
+        cache.reset_counts()
+        self.assertEqual(self.search('import os', '.*\\.py$', cache=cache),
+            expected)
+        self.assertEqual(cache.counts, {'dir_hits': 1, 'dir_misses': 2,
+            'file_hits': 2, 'file_misses': 3})
+        # cache is saved to and loaded from json (outside searched folder)
+        folder = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(folder, 'cache.json')
+            self.search('import os', '.*\\.py$', cache=filename)
+            cache = utils.SearchCache(filename)
+            self.assertEqual(self.search('import os', '.*\\.py$',
+                cache=cache), expected)
+        finally:
+            shutil.rmtree(folder)
+        self.assertEqual(cache.counts['dir_misses'], 0)
+        self.assertEqual(cache.counts['file_misses'], 0)
+
+    def test_cache_limit(self):
+        # least recently used entries are removed as entries are added
+        cache = utils.SearchCache(max_entries=3)
+        expected = self.search('import os', '.*\\.py$')
+        self.assertEqual(self.search('import os', '.*\\.py$', cache=cache),
+            expected)
+        self.assertEqual(len(cache.dirs) + len(cache.files), 3)
+        self.assertEqual(list(cache.files),
+            [os.path.join(self.folder, 'sub', name)
+             for name in ['c.py', os.path.join('deep', 'd.py')]])
+        # hits are moved to most recently used
+        filename = os.path.join(self.folder, 'sub', 'c.py')
+        st = utils._stat_key(filename)
+        key = list(cache.files[filename]['matches'])[0]
+        self.assertEqual(cache.get_match(filename, st, key), False)
+        self.assertEqual(list(cache.files)[-1], filename)
+        cache.max_entries = 1
+        cache.evict()
+        self.assertEqual(list(cache.files), [filename])
+        self.assertEqual(cache.dirs, {})
+        # limit is applied to loaded caches
+        folder = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(folder, 'cache.json')
+            self.search('import os', '.*\\.py$', cache=filename)
+            cache = utils.SearchCache(filename, max_entries=2)
+            self.assertEqual(len(cache.dirs) + len(cache.files), 2)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_getfield_group(self):
+        A = {'a': {'b': 1, 'c': 'x'}, 'd': [{'b': 2}]}
+        expr = ['.*\\["b"\\]', '.*\\["a"\\]', '.*\\["(?:b|c)"\\]']
+        C, S, R = utils.pebl_getfield(A, expr=expr, group=True)
+        for e in expr:
+            C_, S_, R_ = utils.pebl_getfield(A, expr=e)
+            self.assertEqual((C[e], S[e], R[e]), (C_, S_, R_), e)
+        self.assertEqual(R['.*\\["b"\\]'], ['["a"]["b"]', '["d"][0]["b"]'])
+        C, S, R = utils.pebl_getfield(A, expr=expr)
+        self.assertEqual(R, ['["a"]', '["a"]["b"]', '["a"]["c"]',
+                             '["d"][0]["b"]'])
+
+class Py2matTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, 'batch.mat')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_roundtrip(self):
+        A = {'a': 1, 'b': 'x', 'c': [1.5, 2.5], 'd': {'e': np.arange(3)}}
+        utils.py2mat(A, self.filename, 'A')
+        expected = {'a': 1, 'b': 'x', 'c': [1.5, 2.5], 'd': {'e': [0, 1, 2]}}
+        self.assertEqual(utils.py2mat(None, self.filename, 'A'), expected)
+        view = utils.py2mat(None, self.filename, 'A', lazy=True)
+        self.assertEqual(view.convert(), expected)
+        self.assertEqual(utils.subsref(view, ['d', 'e']), [0, 1, 2])
+
+    def test_view_slice(self):
+        A = {'a': [1, 2, 3], 'c': [{'x': 1}, {'x': 2}, {'x': 3}]}
+        utils.py2mat(A, self.filename, 'A')
+        view = utils.py2mat(None, self.filename, 'A', lazy=True)
+        self.assertTrue(isinstance(view['c'], utils.MatView))
+        for S in [['a', '0:2'], ['c', '1:'], ['c', '::2', 0]]:
+            self.assertEqual(utils.subsref(view, S), utils.subsref(A, S), S)
+        self.assertEqual(view['c'][slice(1, None)], A['c'][1:])
+
+    def test_batch(self):
+        A = [{'spm': {'spatial': {'realign': {'data': ['a.nii', 'b.nii'],
+              'eoptions': {'quality': 0.9, 'sep': 4}}}}}]
+        utils.py2mat(A, self.filename, 'matlabbatch')
+        B = utils.py2mat(None, self.filename, 'matlabbatch')
+        self.assertEqual(B, A[0])
+        # cached loads are copies
+        cache = utils.MatCache()
+        B = utils.py2mat(None, self.filename, 'matlabbatch', cache=cache)
+        B['spm'] = None
+        B = utils.py2mat(None, self.filename, 'matlabbatch', cache=cache)
+        self.assertEqual(B, A[0])
+        self.assertEqual(cache.counts['hits'], 1)
+
+    def test_sidecar(self):
+        A = {'a': 1, 'b': ['x', 'y']}
+        utils.py2mat(A, self.filename, 'A')
+        folder = os.path.join(self.folder, 'sidecars')
+        os.mkdir(folder)
+        cache = utils.MatCache(sidecar=True, sidecar_dir=folder)
+        self.assertEqual(cache.load(self.filename, 'A'), A)
+        sidecar = cache.sidecar_name(self.filename, 'A')
+        self.assertTrue(os.path.isfile(sidecar))
+        # sidecar is loaded by a new cache
+        cache = utils.MatCache(sidecar=True, sidecar_dir=folder)
+        self.assertEqual(cache.load(self.filename, 'A'), A)
+        self.assertEqual(cache.load(self.filename, 'A'), A)
+        self.assertEqual(cache.counts, {'hits': 1, 'misses': 1,
+            'sidecar_hits': 1, 'sidecar_misses': 0})
+        # changed files are converted again
+        utils.py2mat({'a': 2}, self.filename, 'A')
+        st = os.stat(self.filename)
+        os.utime(self.filename, (st.st_atime, st.st_mtime + 10))
+        cache = utils.MatCache(sidecar=True, sidecar_dir=folder)
+        self.assertEqual(cache.load(self.filename, 'A'), {'a': 2})
+        self.assertEqual(cache.counts['sidecar_misses'], 1)
+        # failed sidecar writes leave no temporary file
+        os.remove(sidecar)
+        os.mkdir(sidecar)
+        cache = utils.MatCache(sidecar=True, sidecar_dir=folder)
+        self.assertEqual(cache.load(self.filename, 'A'), {'a': 2})
+        self.assertEqual(cache.load(self.filename, 'A'), {'a': 2})
+        self.assertEqual(cache.counts['hits'], 1)
+        self.assertEqual(os.listdir(folder), [os.path.basename(sidecar)])
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.template = [{'spm': {'realign': {'data': '<UNDEFINED>',
+                                              'quality': 0.9}}}]
+        self.paths = ['[0]["spm"]["realign"]["data"]']
+        self.filenames = os.path.join(self.folder, 'batch_{n:03d}.mat')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_export(self):
+        values = [['a.nii'], ['b.nii'], ['c.nii']]
+        for n_jobs in [1, 2]:
+            done = []
+            files, errors = utils.pebl_export(self.template, self.paths,
+                values, self.filenames, n_jobs=n_jobs,
+                callback=lambda *args: done.append(args))
+            self.assertEqual(errors, {})
+            self.assertEqual(files, [self.filenames.format(n=n)
+                                     for n in range(3)])
+            self.assertEqual(sorted([d[0] for d in done]), [1, 2, 3])
+            for filename, row in zip(files, values):
+                A = utils.py2mat(None, filename, 'matlabbatch')
+                self.assertEqual(A['spm']['realign'],
+                    {'data': row[0], 'quality': 0.9})
+        self.assertEqual(self.template[0]['spm']['realign']['data'],
+            '<UNDEFINED>')
+
+    def test_errors(self):
+        # failed rows keep existing files and leave no temporary file
+        files, _ = utils.pebl_export(self.template, self.paths, [['old.nii']],
+            self.filenames)
+        for n_jobs in [1, 2]:
+            values = [[object()], ['b.nii'], [lambda x: x]]
+            files, errors = utils.pebl_export(self.template, self.paths,
+                values, self.filenames, n_jobs=n_jobs)
+            self.assertTrue(errors[0].startswith('TypeError: '), errors)
+            A = utils.py2mat(None, files[0], 'matlabbatch')
+            self.assertEqual(A['spm']['realign']['data'], 'b.nii')
+            A = utils.py2mat(None, self.filenames.format(n=0), 'matlabbatch')
+            self.assertEqual(A['spm']['realign']['data'], 'old.nii')
+            # rows that cannot be sent to workers fail alone
+            if n_jobs == 1:
+                self.assertEqual(sorted(errors), [0])
+                names = ['batch_000.mat', 'batch_001.mat', 'batch_002.mat']
+            else:
+                self.assertEqual(sorted(errors), [0, 2])
+                names = ['batch_000.mat', 'batch_001.mat']
+            self.assertEqual(sorted(os.listdir(self.folder)), names)
+            os.remove(files[-1])
+
+class Option(object):
+    def __init__(self, value):
+        self.value = value
+
+class HashTest(unittest.TestCase):
+    def test_hash(self):
+        A = {'a': [1, 2], 'b': np.arange(6).reshape(2, 3)}
+        self.assertEqual(utils.pebl_hash(A),
+            utils.pebl_hash({'b': np.arange(6).reshape(2, 3), 'a': [1, 2]}))
+        self.assertNotEqual(utils.pebl_hash(A),
+            utils.pebl_hash({'a': [1, 2], 'b': np.arange(6).reshape(3, 2)}))
+        self.assertEqual(utils.pebl_hash({'x', 'y'}),
+            utils.pebl_hash({'y', 'x'}))
+        self.assertNotEqual(utils.pebl_hash(Option(1)),
+            utils.pebl_hash(Option(2)))
+        self.assertRaises(TypeError, utils.pebl_hash, lambda x: x)
+
+    def test_memoize(self):
+        calls = []
+        @utils.pebl_memoize()
+        def step(A, option):
+            calls.append(option.value)
+            return option.value * 10
+        self.assertEqual(step({'a': 1}, Option(1)), 10)
+        self.assertEqual(step({'a': 1}, Option(2)), 20)
+        self.assertEqual(step({'a': 1}, Option(1)), 10)
+        self.assertEqual(calls, [1, 2])
+
+class DiffTest(unittest.TestCase):
+    def test_example(self):
+        A = {0: {'spm': {'data': '<UNDEFINED>', 'so': [1, 2]}}}
+        B = {0: {'spm': {'data': './a.nii', 'so': [1, 2, 3]}}, 1: {}}
+        diff = utils.pebl_diff(A, B)
+        self.assertEqual(diff['added'], ['[0]["spm"]["so"][2]', '[1]'])
+        self.assertEqual(diff['changed'], ['[0]["spm"]["data"]'])
+        self.assertEqual(diff['removed'], [])
+        self.assertEqual(utils.pebl_patch(A, diff), B)
+        diff = utils.pebl_diff(B, A)
+        self.assertEqual(diff['removed'], ['[0]["spm"]["so"][2]', '[1]'])
+        self.assertEqual(utils.pebl_patch(B, diff), A)
+        self.assertEqual(utils.pebl_diff(A, B, r=0)['changed'], ['[0]'])
+
+    def test_random(self):
+        rng = random.Random(1)
+        for _ in range(300):
+            A = gen_value(rng)
+            if rng.random() < 0.8:
+                S = gen_paths(rng, A, rng.randint(1, 3))
+                try:
+                    B = set_each(A, S, [gen_value(rng, 2) for _ in S])
+                except (IndexError, KeyError, TypeError, ValueError):
+                    continue
+            else:
+                B = gen_value(rng)
+            diff = utils.pebl_diff(A, B)
+            same = not (diff['added'] or diff['removed'] or diff['changed'])
+            self.assertEqual(same, utils.pebl_hash(A) == utils.pebl_hash(B))
+            hash_A = utils.pebl_hash(A)
+            for copy_mode in ['deep', 'path']:
+                P = utils.pebl_patch(A, diff, copy_mode)
+                self.assertEqual(utils.pebl_hash(P), utils.pebl_hash(B))
+                self.assertEqual(utils.pebl_hash(A), hash_A)
+            P = utils.pebl_patch(copy.deepcopy(A), diff, 'none')
+            self.assertEqual(utils.pebl_hash(P), utils.pebl_hash(B))
+
+if __name__ == '__main__':
+    unittest.main()
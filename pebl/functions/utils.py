@@ -1,10 +1,164 @@
 import os
 import numpy as np
 import sys
-import cStringIO
+try:
+    import cStringIO
+except ImportError: # python 3
+    import io as cStringIO
 import re
 import scipy.io as sio
 import copy
+import json
+import time
+import mmap
+import multiprocessing
+import threading
+import functools
+import itertools
+import atexit
+import collections
+import hashlib
+import binascii
+try:
+    import cPickle as pickle
+except ImportError: # python 3
+    import pickle
+from multiprocessing.pool import ThreadPool
+
+# chunk size and overlap (bytes) used when searching file text in chunks
+_CHUNK_SIZE = 1 << 20
+_CHUNK_OVERLAP = 1 << 12
+
+# length of str of each element in an object array
+_str_len = np.frompyfunc(lambda x: len(str(x)), 1, 1)
+
+# profiling stats (None unless profiling is enabled, see profile)
+_stats = None
+_stats_lock = threading.Lock()
+
+# compiled patterns (least recently used first, see compile_pattern)
+_pattern_cache = collections.OrderedDict()
+_pattern_cache_size = 256
+_pattern_lock = threading.Lock()
+_pattern_type = type(re.compile(''))
+
+# integer and literal suffix (e.g., '.*\.nii$') expressions
+_int_pattern = re.compile('^-?\d+$')
+_suffix_pattern = re.compile(r'^\.\*((?:[^\\.^$*+?{}\[\]|()]|'
+                             r'\\[^A-Za-z0-9])*)\$$')
+
+def set_pattern_cache_size(n):
+    ''' set number of compiled patterns kept by compile_pattern
+
+        Parameters:
+        n - int, maximum number of cached patterns (0 disables caching)
+
+        Returns:
+        None
+    '''
+    global _pattern_cache_size
+    with _pattern_lock:
+        _pattern_cache_size = n
+        while len(_pattern_cache) > max(n, 0):
+            _pattern_cache.popitem(last=False)
+
+def compile_pattern(expr, flags=0):
+    ''' return compiled pattern for expr using a least recently used cache
+
+        Parameters:
+        expr - str, bytes, or compiled pattern, expression to compile
+            (compiled patterns are returned as is)
+        flags - int, flags used to compile expr
+            [default is 0]
+
+        Returns:
+        pattern - compiled pattern
+
+        Example:
+        pattern = compile_pattern('.*\.nii$')
+        pattern.match('anat.nii') != None
+        True
+
+        Note: Unlike the re module cache, which is cleared when full, only the
+        least recently used pattern is removed (see set_pattern_cache_size).
+    '''
+    if isinstance(expr, _pattern_type):
+        return expr
+    key = (type(expr), expr, flags)
+    with _pattern_lock:
+        pattern = _pattern_cache.pop(key, None)
+        if pattern != None:
+            _pattern_cache[key] = pattern
+            return pattern
+    pattern = re.compile(expr, flags)
+    with _pattern_lock:
+        if _pattern_cache_size > 0:
+            _pattern_cache[key] = pattern
+            while len(_pattern_cache) > _pattern_cache_size:
+                _pattern_cache.popitem(last=False)
+    return pattern
+
+def _pattern_str(expr):
+    ''' return expression string of expr (or None if expr is a compiled pattern
+        with flags that would be lost)
+    '''
+    if isinstance(expr, _pattern_type):
+        if expr.flags != compile_pattern(expr.pattern).flags:
+            return None
+        return expr.pattern
+    return expr
+
+def _as_bytes(expr):
+    ''' return bytes pattern (compiled if expr is compiled) for expr '''
+    if isinstance(expr, _pattern_type):
+        if isinstance(expr.pattern, bytes):
+            return expr
+        flags = expr.flags & ~re.UNICODE
+        return compile_pattern(expr.pattern.encode('utf-8'), flags)
+    if isinstance(expr, bytes):
+        return expr
+    return expr.encode('utf-8')
+
+def _name_matcher(expr):
+    ''' return function returning True if name matches expr (using endswith
+        for expressions of the form '.*<literal>$')
+    '''
+    pattern = compile_pattern(expr)
+    text = _pattern_str(expr)
+    m = None
+    if isinstance(text, str):
+        m = _suffix_pattern.match(text)
+    if m == None:
+        return lambda name: pattern.match(name) != None
+    # unescape literal suffix
+    suffix = re.sub(r'\\(.)', r'\1', m.group(1))
+    def match(name):
+        # '.' does not match newlines
+        if '\n' in name:
+            return pattern.match(name) != None
+        return name.endswith(suffix)
+    return match
+
+def _strtable_rows(celltable, delim='\t'):
+    ''' yield each row of the string table for celltable (see cell2strtable) '''
+    # change \t to 4 spaces
+    if delim == '\t':
+        delim = '    '
+    # check that celltable is ndarray and object
+    if type(celltable) != np.ndarray:
+        celltable = np.array(celltable, dtype=np.object)
+    elif celltable.dtype != np.object:
+        celltable = celltable.astype(np.object)
+    # if len(shape) < 2, reshape
+    if celltable.ndim < 2:
+        celltable = np.reshape(celltable, (1,-1))
+    if celltable.size == 0:
+        return
+    # get max length in each column
+    max_len = _str_len(celltable).astype(int).max(axis=0)
+    # pad each column with spaces and join with delim
+    for r in celltable:
+        yield delim.join([str(c).ljust(n) for c, n in zip(r, max_len)])
 
 def cell2strtable(celltable, delim='\t'):
     ''' convert a cell table into a string table that can be printed nicely
@@ -25,53 +179,354 @@ def cell2strtable(celltable, delim='\t'):
         print(strtable)
         Column 1 Title                 Column 2 Title
         Row 2 Column 1 is longer...    Row 2 Column 2    Extra Column!
+
+        Note: See write_strtable to write a large table to a file row by row.
     '''
-    # change \t to 4 spaces
-    if delim == '\t':
-        delim = '    '
-    # check that celltable is ndarray and object
-    if type(celltable) != np.ndarray:
-        celltable = np.array([celltable], dtype=np.object)
-    elif celltable.dtype != np.object: # copy as np.object
-        celltable = copy.deepcopy(celltable).astype(np.object)
-    else: # copy as is
-        celltable = copy.deepcopy(celltable)
-    # if len(shape) == 1, reshape
-    if len(celltable.shape)==1:
-        celltable = np.reshape(celltable, (1,celltable.shape[0]))
-    # convert all to string
-    for i,x in enumerate(celltable.ravel()):
-        celltable.ravel()[i] = np.str(x)
-    # get max length in each column
-    max_len = []
-    for x in celltable.transpose():
-        max_len.append(np.max([len(y) for y in x]))
-    # pad each column with zeros
-    for i,r in enumerate(celltable):
-        for ii,c in enumerate(r):
-            if len(c) < max_len[i]:
-                spaces = ''.join([' ' for n in range(max_len[ii]-len(c))])
-                celltable[i][ii] = c + spaces
-    # join strings with delim
-    strtable = []
-    if len(celltable.shape) > 1:
-        for r in range(celltable.shape[0]):
-            strtable.append(delim.join(celltable[r]))
-        strtable = '\n'.join(strtable)
+    return '\n'.join(_strtable_rows(celltable, delim))
+
+def write_strtable(celltable, f, delim='\t'):
+    ''' write a cell table as a string table to a file-like object row by row
+
+        Parameters:
+        celltable - array-like, ndarray with rows and columns in desired order
+        f - file-like, object with write method (e.g., open file or sys.stdout)
+        delim - str, delimter to combine columns of celltable
+            [default = '\\t' (strictly 4 spaces)]
+
+        Returns:
+        None
+
+        Example:
+        celltable = np.array([['subject','status'],['sub01','done']])
+        with open('status.txt', 'w') as f:
+            write_strtable(celltable, f)
+
+        Note: The text written is the same as cell2strtable(celltable, delim).
+    '''
+    for i, row in enumerate(_strtable_rows(celltable, delim)):
+        if i > 0:
+            f.write('\n')
+        f.write(row)
+
+def _mat_key(A_, S_):
+    ''' return output key (or None if dimension is dropped) and whether A_ is a
+        cell for index S_ of loadmat array A_ (see py2mat)
+    '''
+    # cell index
+    if A_.dtype == np.object:
+        # set single index or cell array
+        if A_.ndim == 1 or (A_.ndim > 0 and A_.shape[0] > 1):
+            return S_, True
+    # field name
+    elif A_.dtype.names != None:
+        # set fieldname
+        if A_.ndim == 0:
+            return A_.dtype.names[S_], False
+        # set noncell array
+        elif A_.shape[0] > 1:
+            return S_, False
+    elif A_.ndim > 0 and A_.shape[0] > 1:
+        return S_, False
+    return None, False
+
+def _mat_leaves(A, implied=True):
+    ''' yield output substruct, cell substructs, and value for each value in
+        loadmat array A (see py2mat). If implied is True, the first index of A
+        is dropped from output substructs (i.e., A is the loaded variable).
+    '''
+    children = _children(A)
+    if children == None:
+        yield [], [], A
+        return
+    # depth-first search, keeping output substruct and cell lengths per level
+    if implied:
+        stack = [(None, children)]
+    else:
+        stack = [(A, children)]
+    S1 = []
+    cells = []
+    lens = []
+    while len(stack) > 0:
+        A_, children = stack[-1]
+        item = next(children, None)
+        # pop finished level
+        if item == None:
+            stack.pop()
+            if len(lens) > 0:
+                n_S1, n_cells = lens.pop()
+                del S1[n_S1:]
+                del cells[n_cells:]
+            continue
+        S_, value = item
+        # update output substruct (root index is implied)
+        lens.append((len(S1), len(cells)))
+        if A_ is not None:
+            key, is_cell = _mat_key(A_, S_)
+            if key != None:
+                S1.append(key)
+                if is_cell:
+                    cells.append(len(S1))
+        # yield value or descend
+        children = _children(value)
+        if children == None:
+            yield list(S1), [S1[:n] for n in cells], value
+            n_S1, n_cells = lens.pop()
+            del S1[n_S1:]
+            del cells[n_cells:]
+        else:
+            stack.append((value, children))
+
+def _py2mat_value(value, parent_list=False):
+    ''' convert value to matlab format: dicts to record arrays (with keys as
+        dtype) and lists without preceding or following list to lists with an
+        additional dimension (see py2mat)
+    '''
+    if type(value) == dict:
+        keys = list(value.keys())
+        values = [_py2mat_value(value[k]) for k in keys]
+        return np.array([tuple(values)],
+            np.dtype([(k, np.object) for k in keys]))
+    elif type(value) == list:
+        out = [_py2mat_value(v, True) for v in value]
+        # if list without following or preceding list, set extra dim
+        if not parent_list and len(value) > 0 and type(value[0]) != list:
+            out = [out]
+        return out
+    elif type(value) == tuple:
+        return tuple([_py2mat_value(v) for v in value])
+    elif isinstance(value, (np.ndarray, np.void)) and \
+        (value.dtype == np.object or value.dtype.names != None):
+        out = value.copy()
+        for idx in np.ndindex(np.shape(out)):
+            if out.dtype.names == None:
+                out[idx] = _py2mat_value(out[idx])
+            else:
+                for name in out.dtype.names:
+                    out[idx][name] = _py2mat_value(out[idx][name])
+        return out
+    return value
+
+def _object_array(values):
+    ''' return 1-d object array of values (without expanding nested
+        sequences) built in a single allocation
+    '''
+    arr = np.empty(len(values), dtype=np.object)
+    for i, value in enumerate(values):
+        arr[i] = value
+    return arr
+
+def _return_type(values, return_type='list'):
+    ''' return list of values as list or 1-d object array (see pebl_getfield)
+    '''
+    if return_type == 'list':
+        return values
+    elif return_type == 'array':
+        return _object_array(values)
+    raise ValueError('unknown return_type: {return_type}'.format(
+        return_type=return_type))
+
+def _mat_convert(sources, implied=True, cells=(), skip_first=True):
+    ''' convert loadmat arrays in sources to a single output value (see py2mat)
+
+        Parameters:
+        sources - list, loadmat arrays at the same output substruct (in order)
+        implied - bool, True if sources is the loaded variable
+            [default is True]
+        cells - list, cell substructs (relative to the output value) to
+            prepend to each value's cell substructs
+            [default is ()]
+        skip_first - bool, True if the first cell of each value is implied
+            (i.e., there are no cells above the output value)
+            [default is True]
+
+        Returns:
+        out - object, converted output value
+    '''
+    # init out (an object array is built as a list until other keys are set)
+    if implied:
+        out = None
+        items = []
     else:
-        strtable = delim.join(celltable)
-    return strtable
+        out = []
+        items = None
+    # get output substructs, cells, and values in one pass
+    cell = []
+    for A in sources:
+        for S1_, C_, item in _mat_leaves(A, implied):
+            if items != None and len(S1_) > 0 and type(S1_[0]) == int:
+                # pad with None as when appending to object array
+                if S1_[0] >= len(items):
+                    items.extend([None] * (S1_[0] - len(items) + 1))
+                items[S1_[0]] = subsasgn(items[S1_[0]], S1_[1:], item, list,
+                    'none')
+            else:
+                if items != None:
+                    out = _object_array(items)
+                    items = None
+                out = subsasgn(out, S1_, item, list, 'none')
+            cell.append(list(cells) + C_)
+    if items != None:
+        out = _object_array(items)
+    # set cells as numpy arrays
+    for C_ in cell:
+        # first cell is implied
+        for c in C_[int(skip_first):]:
+            out = subsasgn(out, c, np.array([subsref(out, c, 'none')],
+                np.object), copy_mode='none')
+    return out
+
+def _mat_items(A, implied=False):
+    ''' yield output key (or None if value is set at the same output
+        substruct), whether key is a cell, and value for each child of loadmat
+        array A, descending through dropped dimensions (see py2mat)
+    '''
+    children = _children(A)
+    if children == None:
+        return
+    for S_, value in children:
+        if implied:
+            key, is_cell = None, False
+        else:
+            key, is_cell = _mat_key(A, S_)
+        if key != None:
+            yield key, is_cell, value
+        elif _children(value) == None:
+            yield None, False, value
+        else:
+            for item in _mat_items(value):
+                yield item
+
+class MatView(object):
+    ''' lazy read-only view of a loaded matlab variable (see py2mat)
+
+        Parameters:
+        sources - list, loadmat arrays at the same output substruct
+        implied - bool, True if sources is the loaded variable
+            [default is False]
+        n_cells - int, number of cells in the output substruct to this view
+            [default is 0]
+        is_cell - bool, True if the output substruct is a cell
+            [default is False]
+
+        Example:
+        A = py2mat(None, 'batch.mat', 'matlabbatch', lazy=True)
+        A[0]['spm']['temporal']['st']['tr']
+        {0: 2}
+        subsref(A, [0, 'spm', 'temporal', 'st', 'nslices'])
+        {0: 28}
+        A.convert() == py2mat(None, 'batch.mat', 'matlabbatch')
+        True
+
+        Note: Values are converted only when indexed (and memoized), matching
+        the values returned by py2mat. Views within cells of cells (which
+        py2mat wraps in arrays) and views with mixed field/index keys are
+        converted entirely when first indexed.
+    '''
+    def __init__(self, sources, implied=False, n_cells=0, is_cell=False):
+        self.sources = sources
+        self.implied = implied
+        self.n_cells = n_cells
+        self.is_cell = is_cell
+        self._items = None
+        self._lazy = None
+        self._value = None
+        self._memo = {}
+
+    def _get_items(self):
+        if self._items == None:
+            self._items = []
+            for A in self.sources:
+                self._items.extend(_mat_items(A, self.implied))
+            # index lazily unless converting could change keys
+            keys = [k for k, _, _ in self._items]
+            self._lazy = len(keys) > 0 and None not in keys and \
+                not (self.is_cell and self.n_cells > 1) and \
+                len(set([isinstance(k, str) for k in keys])) == 1
+        return self._items
+
+    def keys(self):
+        ''' return output keys in order '''
+        if not self._get_items() or not self._lazy:
+            value = self.convert()
+            if type(value) == dict:
+                return list(value.keys())
+            return list(range(len(value)))
+        keys = []
+        for k, _, _ in self._items:
+            if k not in keys:
+                keys.append(k)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __getitem__(self, key):
+        # index converted value with slices (and other unhashable keys)
+        try:
+            if key in self._memo:
+                return self._memo[key]
+        except TypeError:
+            return _getitem(self.convert(), key)
+        self._get_items()
+        sources = [v for k, _, v in self._items if k == key]
+        if not self._lazy or len(sources) == 0:
+            return _getitem(self.convert(), key)
+        is_cell = any([c for k, c, _ in self._items if k == key])
+        value = MatView(sources, False, self.n_cells + is_cell, is_cell)
+        # convert values without children
+        if all([_children(v) == None for v in sources]):
+            value = value.convert()
+        self._memo[key] = value
+        return value
+
+    def get(self, S):
+        ''' return value at substruct or string representation S '''
+        if isinstance(S, str):
+            S = sub2str(S)
+        return subsref(self, S, 'none')
+
+    def convert(self):
+        ''' return converted value (as returned by py2mat) '''
+        if self._value == None:
+            if self.is_cell:
+                cells = [[]]
+            else:
+                cells = []
+            self._value = (_mat_convert(self.sources, self.implied, cells,
+                self.n_cells - self.is_cell == 0),)
+        return self._value[0]
+
+    def __repr__(self):
+        return 'MatView({keys})'.format(keys=self.keys())
 
-def py2mat(A, filename, variable):
+def py2mat(A, filename, variable, do_compression=False, lazy=False,
+           cache=None):
     ''' load from or save to matlab format
 
         Parameters:
         A - object, object to save (set to None if loading from filename)
-        filename - str, file to load from or save to
+        filename - str or file-like, file to load from or save to (an open
+            file-like object is read from or written to directly, e.g. to
+            stream a large batch to a pipe or buffer)
         variable - str, variable name to load or save
+        do_compression - bool, compress matrices when saving
+            [default is False]
+        lazy - bool, return a MatView that converts values only when indexed
+            rather than converting the entire variable when loading
+            [default is False]
+        cache - MatCache or bool, cache used to reuse values loaded from
+            unchanged files (True uses a shared MatCache kept in memory)
+            [default is None]
 
         Returns:
         A - object, object converted from file or converted to matlab format
+            (or MatView if loading with lazy=True)
 
         Example:
         A = {0: {'spm': {'temporal': {'st': {'nslices': {0: 28},
@@ -86,88 +541,438 @@ def py2mat(A, filename, variable):
           'tr': {0: 2}}}}}}
 
     '''
+    # load from cache
+    if A is None and cache not in (None, False) and not lazy and \
+        isinstance(filename, str):
+        if cache is True:
+            cache = _mat_cache
+        return cache.load(filename, variable)
     # load from filename
-    if A==None:
-        # init out
-        out = np.array([], np.object)
-        # load filename as matlab dtype
-        A = sio.loadmat(filename, mat_dtype=True)
+    if A is None:
+        # load variable from filename as matlab dtype
+        A = sio.loadmat(filename, mat_dtype=True, variable_names=[variable])
         A = A[variable]
-        # get substructs of A
-        S0 = struct2sub(A)
-        # for each level, get dtype
-        S1 = np.empty(len(S0), dtype=np.object).tolist()
-        cell = np.zeros(len(S0), dtype=np.bool).tolist()
-        for i,S_ in enumerate(S0):
-            S1[i] = []
-            cell[i] = []
-            for n in range(1, len(S_)):
-                A_ = subsref(A, S_[:n])
-                # cell index
-                if A_.dtype == np.object:
-                    # set single index
-                    if A_.ndim == 1:
-                        S1[i].append(S_[n])
-                        cell[i].append(copy.deepcopy(S1[i]))
-                    # set cell array
-                    elif A_.shape[0] > 1:
-                        S1[i].append(S_[n])
-                        cell[i].append(copy.deepcopy(S1[i]))
-                # field name
-                elif A_.dtype.names != None:
-                    # set fieldname
-                    if A_.ndim == 0:
-                        S1[i].append(A_.dtype.names[S_[n]])
-                    # set noncell array
-                    elif A_.shape[0] > 1:
-                        S1[i].append(S_[n])
-                elif A_.ndim > 0 and A_.shape[0] > 1:
-                    S1[i].append(S_[n])
-        # set values
-        for S0_, S1_ in zip(S0, S1):
-            item = subsref(A, S0_)
-            out = subsasgn(out, S1_, item, list)
-        # set cells as numpy arrays
-        for C_ in cell:
-            # first cell is implied
-            for c in C_[1:]:
-                out = subsasgn(out, c, np.array([subsref(out, c)], np.object))
-    else: # copy A
-        A = copy.deepcopy(A)
-        # get substructs for A at each level
-        S0 = struct2sub(A, dict_out=True)
-        # set additional dimension for matlab
-        for k in S0.keys():
-            for S_ in S0[k]:
-                A_ = subsref(A, S_)
-                # if list without following or preceding list, set extra dim
-                if type(A_)==list and type(subsref(A, S_[:-1]))!=list and \
-                    type(A_[0])!=list:
-                    A = subsasgn(A, S_, [A_])
-                    S0 = struct2sub(A, dict_out=True)
-        # set dicts as arrays with dtype
-        l = S0.keys()
-        l.reverse()
-        for k in l:
-            for S_ in S0[k]:
-                A_ = subsref(A, S_)
-                # set dict to array with keys as dtype
-                if type(A_) == dict:
-                    A = subsasgn(A, S_, np.array([tuple(A_.values())],
-                        np.dtype([(k, np.object) for k in A_.keys()])))
-                    S0 = struct2sub(A, dict_out=True)
+        # convert values of A
+        if lazy:
+            out = MatView([A], True)
+        else:
+            out = _mat_convert([A])
+    else: # convert values of A to matlab format
+        if type(A) == dict:
+            A = dict([(k, _py2mat_value(v)) for k, v in A.items()])
+        elif type(A) == list:
+            A = [_py2mat_value(v, True) for v in A]
+        else:
+            A = _py2mat_value(A)
         # set out to dict using variable
         out = {variable: A}
         # save mat
-        sio.savemat(filename, out)
+        sio.savemat(filename, out, do_compression=do_compression)
+        if isinstance(filename, str):
+            _mat_cache.invalidate(filename)
+            if isinstance(cache, MatCache):
+                cache.invalidate(filename)
     return out
 
-def subsref(A, S):
+class MatCache(object):
+    ''' least recently used cache of values loaded by py2mat, with optional
+        on-disk sidecar files of converted values
+
+        Parameters:
+        max_bytes - int, maximum total size of cached values (as pickled)
+            [default is 256 MB]
+        sidecar - bool, save each converted value to a sidecar file that is
+            loaded instead of converting the file again
+            [default is False]
+        sidecar_dir - str, folder for sidecar files
+            [default is None, saves next to each file]
+
+        Attributes:
+        entries - OrderedDict, (path, variable): (stat, pickled value) from
+            least to most recently used
+        n_bytes - int, total size of cached values
+        counts - dict, number of hits and misses in memory and sidecars
+
+        Example:
+        cache = MatCache(sidecar=True)
+        A = py2mat(None, 'template.mat', 'matlabbatch', cache=cache)
+        A = py2mat(None, 'template.mat', 'matlabbatch', cache=cache)
+        cache.counts =
+        {'hits': 1, 'misses': 1, 'sidecar_hits': 0, 'sidecar_misses': 1}
+
+        Note: Entries are reused only if the mtime, size, and inode of the file
+        are unchanged. Each load returns a new copy of the cached value.
+        Sidecars are pickle files, so only use sidecar_dir folders that are
+        not writable by others.
+    '''
+    def __init__(self, max_bytes=256 << 20, sidecar=False, sidecar_dir=None):
+        self.max_bytes = max_bytes
+        self.sidecar = sidecar
+        self.sidecar_dir = sidecar_dir
+        self.entries = collections.OrderedDict()
+        self.n_bytes = 0
+        self._lock = threading.Lock()
+        self.reset_counts()
+
+    def reset_counts(self):
+        ''' set hit/miss counts to zero '''
+        self.counts = {'hits': 0, 'misses': 0, 'sidecar_hits': 0,
+            'sidecar_misses': 0}
+
+    def sidecar_name(self, filename, variable):
+        ''' return sidecar filename for variable in filename '''
+        filename = os.path.abspath(filename)
+        name = '{name}.{variable}.pkl'.format(name=os.path.basename(filename),
+            variable=variable)
+        if self.sidecar_dir != None:
+            return os.path.join(self.sidecar_dir, name)
+        return os.path.join(os.path.dirname(filename), name)
+
+    def _set(self, key, st, data):
+        with self._lock:
+            old = self.entries.pop(key, None)
+            if old != None:
+                self.n_bytes -= len(old[1])
+            if len(data) > self.max_bytes:
+                return
+            self.entries[key] = (st, data)
+            self.n_bytes += len(data)
+            # evict least recently used
+            while self.n_bytes > self.max_bytes:
+                _, (_, old) = self.entries.popitem(last=False)
+                self.n_bytes -= len(old)
+
+    def _load_sidecar(self, filename, variable, st):
+        sidecar = self.sidecar_name(filename, variable)
+        try:
+            with open(sidecar, 'rb') as f:
+                header = pickle.load(f)
+                if header != [variable, st]:
+                    return None
+                return f.read()
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def _save_sidecar(self, filename, variable, st, data):
+        sidecar = self.sidecar_name(filename, variable)
+        # write to temporary file, then replace
+        tmp = sidecar + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump([variable, st], f, pickle.HIGHEST_PROTOCOL)
+                f.write(data)
+            if os.path.exists(sidecar):
+                os.remove(sidecar)
+            os.rename(tmp, sidecar)
+        except (IOError, OSError):
+            # sidecars are optional, so remove partial file and continue
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def load(self, filename, variable):
+        ''' return value of variable loaded from filename (see py2mat), using
+            cached value if filename is unchanged
+        '''
+        key = (os.path.abspath(filename), variable)
+        st = _stat_key(filename)
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry != None and entry[0] == st:
+                self.entries[key] = entry
+                self.counts['hits'] += 1
+                return pickle.loads(entry[1])
+            elif entry != None:
+                self.n_bytes -= len(entry[1])
+            self.counts['misses'] += 1
+        # load sidecar or convert file
+        data = None
+        if self.sidecar:
+            data = self._load_sidecar(filename, variable, st)
+            if data != None:
+                self.counts['sidecar_hits'] += 1
+            else:
+                self.counts['sidecar_misses'] += 1
+        if data == None:
+            value = py2mat(None, filename, variable)
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            if self.sidecar:
+                self._save_sidecar(filename, variable, st, data)
+        else:
+            value = pickle.loads(data)
+        self._set(key, st, data)
+        return value
+
+    def invalidate(self, filename=None):
+        ''' remove entries for filename (or all entries) '''
+        with self._lock:
+            if filename == None:
+                self.entries.clear()
+                self.n_bytes = 0
+                return
+            filename = os.path.abspath(filename)
+            for key in list(self.entries.keys()):
+                if key[0] == filename:
+                    self.n_bytes -= len(self.entries.pop(key)[1])
+
+# shared cache used by py2mat(..., cache=True)
+_mat_cache = MatCache()
+
+# template, substructs, and options set in each export worker
+_export_args = None
+
+def _export_init(template, S, variable, do_compression):
+    ''' set export arguments once per worker (see pebl_export) '''
+    global _export_args
+    _export_args = (template, S, variable, do_compression)
+
+def _export_error(e):
+    ''' return error message for exception e (see pebl_export) '''
+    return '{name}: {msg}'.format(name=type(e).__name__, msg=e)
+
+def _export_task(task, args=None):
+    ''' set row values in template and save to filename, returning (n,
+        filename, error message or None) (args are set by _export_init in
+        workers, and rows sent to workers are pickled)
+    '''
+    n, filename, row = task
+    if args == None:
+        args = _export_args
+    template, S, variable, do_compression = args
+    tmp = filename + '.tmp'
+    try:
+        if isinstance(row, bytes):
+            row = pickle.loads(row)
+        else:
+            row = [copy.deepcopy(C_) for C_ in row]
+        # copy only containers along S (template is shared between tasks)
+        A = _set_paths(template, S, row, 'path')
+        # write to temporary file, then replace (no partial file on error)
+        with open(tmp, 'wb') as f:
+            py2mat(A, f, variable, do_compression)
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmp, filename)
+        _mat_cache.invalidate(filename)
+        return n, filename, None
+    except Exception as e:
+        try:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        except OSError:
+            pass
+        return n, filename, _export_error(e)
+
+def pebl_export(template, paths, values, filenames, variable='matlabbatch',
+                n_jobs=1, do_compression=False, verbose=False, callback=None):
+    ''' save a matlab file for each row of values set in template
+
+        Parameters:
+        template - object, template to set values in (not modified)
+        paths - list, substructs or string representations of each column of
+            values
+        values - list, rows of values to set at paths (one row per file)
+        filenames - list or str, filename for each row or format string
+            formatted with the row values and n (the row index)
+        variable - str, variable name to save
+            [default is 'matlabbatch']
+        n_jobs - int, number of worker processes (-1 uses one worker per cpu)
+            [default is 1]
+        do_compression - bool, compress matrices when saving
+            [default is False]
+        verbose - bool, print progress as each file is saved
+            [default is False]
+        callback - function, called as callback(n_done, n_total, filename,
+            error) as each file is saved
+            [default is None]
+
+        Returns:
+        files - list, filenames saved (in order of rows)
+        errors - dict, error message for each row index that failed
+
+        Example:
+        template = py2mat(None, 'template.mat', 'matlabbatch')
+        paths = ['[0]["spm"]["spatial"]["realign"]["estwrite"]["data"]']
+        values = [['/study/sub01/func.nii'], ['/study/sub02/func.nii']]
+        files, errors = pebl_export(template, paths, values,
+            '/study/batches/batch_{n:03d}.mat', n_jobs=-1)
+        files =
+        ['/study/batches/batch_000.mat', '/study/batches/batch_001.mat']
+        errors =
+        {}
+
+        Note: The template is sent to each worker once, and each row copies
+        only the containers along paths (see subsasgn with copy_mode='path').
+        Each file is saved to filename + '.tmp' and then renamed, so rows that
+        fail leave no partial file.
+    '''
+    # get substructs and filenames
+    S = [sub2str(S_) if isinstance(S_, str) else list(S_) for S_ in paths]
+    values = [list(row) for row in values]
+    if isinstance(filenames, str):
+        filenames = [filenames.format(*row, n=n)
+                     for n, row in enumerate(values)]
+    tasks = [(n, filename, row)
+             for n, (filename, row) in enumerate(zip(filenames, values))]
+    # save in process pool or in this process
+    if n_jobs == -1:
+        n_jobs = multiprocessing.cpu_count()
+    args = (template, S, variable, do_compression)
+    if n_jobs > 1:
+        # pickle rows here so that rows that cannot be sent fail alone
+        failed = []
+        sent = []
+        for n, filename, row in tasks:
+            try:
+                sent.append((n, filename,
+                             pickle.dumps(row, pickle.HIGHEST_PROTOCOL)))
+            except Exception as e:
+                failed.append((n, filename, _export_error(e)))
+        pool = multiprocessing.Pool(min(n_jobs, max(len(sent), 1)),
+            _export_init, args)
+        results = itertools.chain(failed, pool.imap_unordered(_export_task,
+            sent, chunksize=max(1, len(sent) // (n_jobs * 4))))
+    else:
+        pool = None
+        task = functools.partial(_export_task, args=args)
+        results = (task(t) for t in tasks)
+    errors = {}
+    saved = set()
+    try:
+        for i, (n, filename, error) in enumerate(results):
+            if error != None:
+                errors[n] = error
+            else:
+                saved.add(n)
+            if verbose:
+                print('{i}/{N}: {name}{error}'.format(i=i + 1,
+                    N=len(tasks), name=filename,
+                    error=' ({error})'.format(error=error) if error else ''))
+            if callback != None:
+                callback(i + 1, len(tasks), filename, error)
+    finally:
+        if pool != None:
+            pool.terminate()
+    files = [filename for n, filename, _ in tasks if n in saved]
+    return files, errors
+
+def _parse_slice(S_):
+    ''' convert a slice string (e.g., '0:3' or '::2') to a slice object
+
+        Parameters:
+        S_ - any, substruct element to convert
+
+        Returns:
+        S_ - slice or None, slice object if S_ is a valid slice string,
+            otherwise None
+    '''
+    # precompiled slice from SubPath
+    if type(S_) == _SliceKey:
+        return S_.slice
+    if not isinstance(S_, str) or ':' not in S_:
+        return None
+    parts = S_.split(':')
+    if len(parts) > 3:
+        return None
+    idx = []
+    for p in parts:
+        p = p.strip()
+        if p == '':
+            idx.append(None)
+        elif _int_pattern.match(p) != None:
+            idx.append(int(p))
+        else:
+            return None
+    return slice(*idx)
+
+def _is_fieldname(value, S_):
+    ''' return True if S_ is a field name of a structured ndarray/np.void '''
+    return isinstance(value, (np.ndarray, np.void)) and \
+        value.dtype.names != None and S_ in value.dtype.names
+
+def _getitem(value, S_):
+    ''' index value at a single substruct element S_ without copying '''
+    # dicts are indexed by key as is
+    if type(value) != dict:
+        idx = _parse_slice(S_)
+        if idx != None:
+            return value[idx]
+    return value[S_]
+
+def _setitem(value, S_, C):
+    ''' set C at a single substruct element S_ of value in place '''
+    if type(value) != dict:
+        idx = _parse_slice(S_)
+        if idx != None:
+            value[idx] = C
+            return
+    value[S_] = C
+
+def _shallow_copy(value):
+    ''' copy a single container level (used for copy-on-write) '''
+    if isinstance(value, dict):
+        return value.copy()
+    elif isinstance(value, list):
+        return list(value)
+    elif isinstance(value, (np.ndarray, np.void)):
+        return value.copy()
+    return value
+
+def _default_value(A, append_type=None):
+    ''' return default value used when adding new indices (see subsasgn) '''
+    # set default for setting new index
+    if append_type == None:
+        def_val = type(A)([])
+    else:
+        def_val = append_type([])
+    # ensure def_val has ndim > 0
+    if type(def_val).__module__ == np.__name__ and def_val.ndim == 0:
+        def_val = np.array([None], dtype=A.dtype)
+    return def_val
+
+def _grow(value, S_, def_val):
+    ''' add index S_ to value if needed, returning updated value (or new value
+        if value must be replaced)
+    '''
+    # add new key to dict
+    if type(value) == dict:
+        if S_ not in value:
+            value[S_] = copy.deepcopy(def_val)
+    # set value to dict and add key with new value type(A)
+    elif isinstance(S_, str) and _parse_slice(S_) == None and \
+        not _is_fieldname(value, S_):
+        value = {}
+        value[S_] = copy.deepcopy(def_val)
+    # append list
+    elif type(value) == list:
+        if not isinstance(S_, str) and S_ >= len(value):
+            for _ in range(S_ - len(value) + 1):
+                value.append(copy.deepcopy(def_val))
+    # append ndarray with None
+    elif type(value).__module__ == np.__name__ and \
+        not isinstance(value, np.void):
+        # elements of numeric ndarrays are not containers
+        if isinstance(value, np.generic):
+            raise TypeError('{name} object does not support item '
+                'assignment'.format(name=type(value).__name__))
+        if value.ndim == 0:
+            value = np.array([value])
+        if not isinstance(S_, str) and S_ >= len(value):
+            value = np.append(value, [None] * (S_ - len(value) + 1))
+    # if None, set as list
+    elif value is None:
+        value = [[] for _ in range(S_ + 1)]
+    return value
+
+def subsref(A, S, copy_mode='deep'):
     ''' return value from A using references in S
 
         Parameters:
         A - object, object to return value from
-        S - list, indices/fields to reference to obtain value from A (see Example)
+        S - list or SubPath, indices/fields to reference to obtain value from A
+            (see Example)
+        copy_mode - str, 'deep' to return a deep copy of the value, 'path' or
+            'none' to return the value referenced within A (no copying)
+            [default is 'deep']
 
         Returns:
         value - any, value to index from A using S
@@ -178,28 +983,37 @@ def subsref(A, S):
         value = subsref(A, S)
         value =
         8
+
+        Note: Only the value at S is copied, so cost is proportional to the
+        length of S (plus the size of the value if copy_mode is 'deep').
     '''
-    # copy S
-    S = list(S)
-    # copy A
-    value = copy.deepcopy(A)
+    if copy_mode not in ('deep', 'path', 'none'):
+        raise ValueError('unknown copy_mode: {mode}'.format(mode=copy_mode))
     # for each substruct, get value
+    value = A
     for S_ in S:
-        if type(S_) == str and re.match('.*:.*', S_) != None:
-            value = eval('value[{S_}]'.format(S_=S_))
-        else:
-            value = value[S_]
+        value = _getitem(value, S_)
+    # convert lazy view
+    if isinstance(value, MatView):
+        value = value.convert()
+    # copy value
+    if copy_mode == 'deep':
+        value = copy.deepcopy(value)
     return value
 
-def subsasgn(A, S, C, append_type=None):
+def subsasgn(A, S, C, append_type=None, copy_mode='deep'):
     ''' set value in A using reference in S
 
         Parameters:
         A - object, object to set value
-        S - list, indices/fields to reference when setting value
+        S - list or SubPath, indices/fields to reference when setting value
         C - any, value to set in A at reference S
         append_type - type, type of iterable to append if needed (e.g., list)
             [default is None, sets to type(A)]
+        copy_mode - str, 'deep' to set value in a deep copy of A, 'path' to
+            copy only the containers along S (copy-on-write, untouched values
+            are shared with A), or 'none' to set value in A in place
+            [default is 'deep']
 
         Returns:
         A - object, updated object with value set at reference S
@@ -214,64 +1028,156 @@ def subsasgn(A, S, C, append_type=None):
 
         Note: Only tested for dict, list, and ndarray. If S == [], A is set to C
     '''
+    if copy_mode not in ('deep', 'path', 'none'):
+        raise ValueError('unknown copy_mode: {mode}'.format(mode=copy_mode))
+    # copy S
+    S = list(S)
     # copy A
-    A = copy.deepcopy(A)
-    value = A
+    if copy_mode == 'deep':
+        A = copy.deepcopy(A)
     # set default for setting new index
-    if append_type == None:
-        def_val = type(A)([])
-    else:
-        def_val = append_type([])
-    # ensure def_val has ndim > 0
-    if type(def_val).__module__ == np.__name__ and def_val.ndim == 0:
-        def_val = np.array([None], dtype=A.dtype)
+    def_val = _default_value(A, append_type)
+    # simple set
+    if len(S) == 0:
+        return C
     # for each level in S, index value
+    parent = None
+    value = A
     for i,S_ in enumerate(S):
-        # add new key to dict
-        if type(value) == dict and S_ not in value.keys():
-            value[S_] = copy.deepcopy(def_val)
-        # set value to dict and add key with new value type(A)
-        elif type(value) != dict and type(S_) == str:
-            value = {}
-            value[S_] = copy.deepcopy(def_val)
-        # append list
-        elif type(value) == list and S_ >= len(value):
-            for _ in range(S_ - len(value) + 1):
-                value.append(copy.deepcopy(def_val))
-        # append ndarray with None
-        elif type(value).__module__ == np.__name__:
-            if value.ndim == 0:
-                value = np.array([value])
-            if S_ >= len(value):
-                for _ in range(S_ - len(value) + 1):
-                    value = np.append(value, None)
-        # if None, set as list
-        elif value == None:
-            value = []
-            for _ in range(S_ - len(value) + 1):
-                value.append([])
+        # copy current container
+        if copy_mode == 'path':
+            value = _shallow_copy(value)
+        # add index S_ if needed
+        value = _grow(value, S_, def_val)
         # set value to A at current substruct
-        if i > 0 and len(S[:i]) > 0:
-            exec('A' + sub2str(S[:i]) + '= value')
+        if i > 0:
+            _setitem(parent, S[i-1], value)
         else:
             A = value
-        # evaluate : string
-        if type(S_) == str and re.match('.*:.*', S_) != None:
-            value = eval('value[{S_}]'.format(S_=S_))
-        else: # index value using S_
-            value = value[S_]
+        # index value using S_
+        parent = value
+        value = _getitem(value, S_)
     # set complete reference to C
-    if len(S) > 0:
-        exec('A' + sub2str(S) + '= C')
-    else: # simple set
-        A = C
+    _setitem(parent, S[-1], C)
     return A
 
+# value that removes the key/index at a substruct (see _set_paths)
+_REMOVE = object()
+
+def _delitems(value, keys):
+    ''' remove keys from dict, or indices from list/ndarray, returning value '''
+    if type(value) == dict:
+        for S_ in keys:
+            value.pop(S_, None)
+    elif type(value) == list:
+        # remove last indices first so earlier indices are not shifted
+        for S_ in sorted(keys, reverse=True):
+            if S_ < len(value):
+                del value[S_]
+    elif isinstance(value, np.ndarray):
+        value = np.delete(value, [S_ for S_ in keys if S_ < len(value)], 0)
+    return value
+
+def _remove_path(A, S, copy_mode='none'):
+    ''' remove key/index at substruct S from A (see subsasgn for copy_mode) '''
+    S = list(S)
+    if len(S) == 0:
+        return A
+    parent = subsref(A, S[:-1], 'none')
+    if copy_mode != 'none':
+        parent = _shallow_copy(parent)
+    parent = _delitems(parent, [S[-1]])
+    return subsasgn(A, S[:-1], parent, copy_mode=copy_mode)
+
+def _set_node(value, node, def_val, copy_mode):
+    ''' set values in value for each substruct in trie node (see _set_paths) '''
+    terminal, keys, children = node
+    # set value, then set any later values within it
+    if terminal != None:
+        value = terminal[0]
+    elif copy_mode == 'path' and len(keys) > 0:
+        value = _shallow_copy(value)
+    removed = []
+    for S_ in keys:
+        if children[S_][0] != None and children[S_][0][0] is _REMOVE:
+            removed.append(S_)
+            continue
+        value = _grow(value, S_, def_val)
+        _setitem(value, S_, _set_node(_getitem(value, S_), children[S_],
+            def_val, copy_mode))
+    if len(removed) > 0:
+        value = _delitems(value, removed)
+    return value
+
+def _set_paths(A, S, C, copy_mode='none', append_type=None):
+    ''' set each value in C at corresponding substruct in S in one traversal
+
+        Parameters:
+        A - object, object to set values
+        S - list, substructs referencing location to set values in A
+        C - list, values to set at each substruct in S
+        copy_mode - str, 'path' to copy only the containers along S (each at
+            most once) or 'none' to set values in A in place
+            [default is 'none']
+        append_type - type, type of iterable to append if needed (see subsasgn)
+            [default is None]
+
+        Returns:
+        A - object, updated object with values set
+
+        Note: Substructs are grouped into a trie by shared prefix so that each
+        container is indexed once. Values set later take precedence over
+        values set earlier at the same substruct or within it. Values that
+        are _REMOVE remove the key/index at the substruct instead. If the
+        order of setting values could change the result (i.e., a container
+        is indexed by slices or by both field names and indices, or A is not
+        a dict or list and could change type), values are set one at a time
+        in order using subsasgn.
+    '''
+    # build trie of [value, keys in order, children] for each level
+    trie = [None, [], {}]
+    ordered = False
+    for S_, C_ in zip(S, C):
+        node = trie
+        for S1 in S_:
+            if S1 not in node[2]:
+                node[1].append(S1)
+                node[2][S1] = [None, [], {}]
+                # check for keys that depend on order
+                if isinstance(S1, str) and (_parse_slice(S1) != None or \
+                    not all(isinstance(k, str) for k in node[1])):
+                    ordered = True
+                elif not isinstance(S1, str) and \
+                    any(isinstance(k, str) for k in node[1]):
+                    ordered = True
+            node = node[2][S1]
+        # set value and remove earlier values within it
+        node[0] = (C_,)
+        node[1] = []
+        node[2] = {}
+    # default value depends on type of A, which must not change
+    if trie[0] != None:
+        root = trie[0][0]
+    else:
+        root = A
+    if type(root) not in [dict, list] or (type(root) == list and \
+        any(isinstance(k, str) for k in trie[1])):
+        ordered = True
+    # set values in order
+    if ordered:
+        for S_, C_ in zip(S, C):
+            if C_ is _REMOVE:
+                A = _remove_path(A, S_, copy_mode)
+            else:
+                A = subsasgn(A, S_, C_, append_type, copy_mode)
+        return A
+    return _set_node(A, trie, _default_value(root, append_type), copy_mode)
+
 def sub2str(S):
     ''' convert a "substruct" to a "string representation" or vice versa
 
     Parameters:
-    S - list or str, substruct/string representation to convert
+    S - list, SubPath, or str, substruct/string representation to convert
 
     Returns:
     S - list or str, converted substruct/string representation
@@ -288,6 +1194,9 @@ def sub2str(S):
     S =
     ['field1', 'field2', 4]
     '''
+    # use cached string representation
+    if isinstance(S, SubPath):
+        return str(S)
     # copy S
     if type(S) != str:
         S = list(S)
@@ -306,13 +1215,173 @@ def sub2str(S):
         if not np.iterable(S):
             S = [S,]
         for S_ in S:
-            if type(S_) == str:
+            if isinstance(S_, str):
                 out.append('"' + S_ + '"')
             else:
                 out.append(str(S_))
         out = '[' + ']['.join(out) + ']'
     return out
 
+class _SliceKey(str):
+    ''' slice string (e.g., '0:3') with its slice object precompiled '''
+    def __new__(cls, S_, idx):
+        self = str.__new__(cls, S_)
+        self.slice = idx
+        return self
+
+class SubPath(object):
+    ''' compiled, hashable "substruct" that caches its list and "string
+        representation" forms (see sub2str)
+
+        Parameters:
+        S - list, tuple, str, or SubPath, substruct or string representation
+
+        Example:
+        S = SubPath('[0]["spm"]["util"]["disp"]')
+        S.tolist()
+        [0, 'spm', 'util', 'disp']
+        str(S)
+        '[0]["spm"]["util"]["disp"]'
+        subsref(A, S + ['data'])
+
+        Note: SubPath can be used anywhere a substruct list is accepted (e.g.,
+        subsref, subsasgn, pebl_getfield, pebl_setfield). Slice strings (e.g.,
+        '0:3') are compiled to slice objects once rather than on each use.
+    '''
+    __slots__ = ('_keys', '_str', '_hash')
+
+    def __init__(self, S=()):
+        if isinstance(S, SubPath):
+            self._keys = S._keys
+            self._str = S._str
+        else:
+            if isinstance(S, str):
+                self._str = S
+                S = sub2str(S)
+            else:
+                self._str = None
+            keys = []
+            for S_ in S:
+                idx = _parse_slice(S_)
+                if idx != None and type(S_) != _SliceKey:
+                    S_ = _SliceKey(S_, idx)
+                keys.append(S_)
+            self._keys = tuple(keys)
+        self._hash = None
+
+    def tolist(self):
+        ''' return substruct as list '''
+        return list(self._keys)
+
+    def __str__(self):
+        if self._str == None:
+            self._str = sub2str(self._keys)
+        return self._str
+
+    def __repr__(self):
+        return 'SubPath({S!r})'.format(S=str(self))
+
+    def __hash__(self):
+        if self._hash == None:
+            self._hash = hash(self._keys)
+        return self._hash
+
+    def __eq__(self, other):
+        if isinstance(other, SubPath):
+            return self._keys == other._keys
+        elif isinstance(other, (list, tuple)):
+            return self._keys == tuple(other)
+        return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return SubPath(self._keys[idx])
+        return self._keys[idx]
+
+    def __add__(self, other):
+        return SubPath(self._keys + tuple(other))
+
+def _children(value):
+    ''' return iterator of (key, child) pairs for a container, or None if value
+        is not a container or is empty
+    '''
+    if type(value) == dict:
+        if len(value) == 0:
+            return None
+        return ((k, value[k]) for k in value.keys())
+    elif type(value) == list or type(value) == tuple:
+        n = len(value)
+    elif type(value).__module__ == np.__name__:
+        if type(value) == np.void:
+            n = len(value)
+        elif value.ndim > 0:
+            n = value.shape[0]
+        else:
+            return None
+    else:
+        return None
+    if n == 0:
+        return None
+    return ((i, value[i]) for i in range(n))
+
+def iter_substructs(A, r=np.inf):
+    ''' iterate over all "substructs" and values from A through levels r
+
+    Parameters:
+    A - object, object to return substructs from
+    r - number, number of levels to search when obtaining substructs. Yields
+        substruct lists with maximum length of r + 1 (0 is first level)
+        [default is np.inf, i.e. all levels of A]
+
+    Returns:
+    generator, yields (S_, value) pairs in depth-first order, where S_ is the
+        substruct list and value is the (uncopied) value at S_ in A
+
+    Example:
+    A = {'test': {0: 12, 1: '2'}, 'test2': 3}
+    list(iter_substructs(A))
+    [(['test', 0], 12), (['test', 1], '2'), (['test2'], 3)]
+
+    Note: Each node is visited once without copying A, and memory use is
+    bounded by the depth of A. Empty containers are yielded as values.
+    '''
+    # if A has no children, yield A
+    children = _children(A)
+    if children == None:
+        yield [], A
+        return
+    # depth-first search using stack of child iterators
+    stack = [children]
+    path = []
+    while len(stack) > 0:
+        item = next(stack[-1], None)
+        # pop finished level
+        if item == None:
+            stack.pop()
+            if len(path) > 0:
+                path.pop()
+            continue
+        S_, value = item
+        # yield value or descend
+        if len(path) < r:
+            children = _children(value)
+        else:
+            children = None
+        if children == None:
+            yield path + [S_], value
+        else:
+            path.append(S_)
+            stack.append(children)
+
 def struct2sub(A, r=np.inf, dict_out=False):
     ''' return all "substructs" from A through levels r
 
@@ -333,71 +1402,576 @@ def struct2sub(A, r=np.inf, dict_out=False):
     r = 1
     S =
     [['test', 0], ['test', 1], ['test2']]
+
+    Note: See iter_substructs for a generator version.
     '''
-    # copy A
-    A = copy.deepcopy(A)
-    # get substruct based on type
-    S = {0: []}
-    if type(A) == dict:
-        S[0] = [[S_] for S_ in A.keys()]
-    elif type(A) == list or type(A) == tuple:
-        S[0] = [[S_] for S_ in range(len(A))]
-    elif type(A).__module__ == np.__name__:
-        if A.ndim > 0 or type(A) == np.void:
-            A = list(A)
-            S[0] = [[S_] for S_ in range(len(A))]
-    # ensure list is not empty
-    if len(S[0]) == 0:
-        S[0] = [[],]
-    # # if r is zero, return
-    if r == 0:
-        return S[0]
-    # for each level, get struct2sub and append to previous
-    r_ = 0
-    while r_ < r:
-        S[r_+1] = []
-        for S0 in S[r_]:
-            for S1 in struct2sub(subsref(A, S0), 0):
-                S[r_+1].append(S0 + S1)
-            if len(struct2sub(subsref(A, S0), 0)) == 0:
-                S[r_+1].append(S[r_])
-        if S[r_] == S[r_+1]:
-            S.pop(r_+1, None)
-            break
-        else:
-            r_ += 1
-    if dict_out: # return dict
+    # get substructs through level r
+    S = [S_ for S_, _ in iter_substructs(A, r)]
+    if r == 0 or not dict_out:
         return S
-    else: # return S at level r_
-        return S[r_]
+    # set each level as the substructs truncated to that level
+    n_levels = max(1, max(len(S_) for S_ in S))
+    out = {}
+    for r_ in range(n_levels):
+        out[r_] = []
+        for S_ in S:
+            if len(out[r_]) == 0 or out[r_][-1] != S_[:r_+1]:
+                out[r_].append(S_[:r_+1])
+    return out
+
+def _parse_path_element(text):
+    ''' return '*', '**', or (set of keys, list of slices) for the text within
+        brackets of a path pattern (see PathPattern)
+    '''
+    text = text.strip()
+    if text in ('*', '**'):
+        return text
+    keys = set()
+    slices = []
+    for item in re.findall('"[^"]*"|\'[^\']*\'|[^,]+', text):
+        item = item.strip()
+        if item[:1] in ('"', "'"):
+            keys.add(item[1:-1])
+        elif _int_pattern.match(item) != None:
+            keys.add(int(item))
+        elif _parse_slice(item) != None:
+            slices.append(_parse_slice(item))
+        elif item != '':
+            raise ValueError('invalid path pattern element: {item}'.format(
+                item=item))
+    return keys, slices
+
+def _in_slice(key, idx, n=None):
+    ''' return True if int key is an index within slice idx (of length n) '''
+    if n != None:
+        start, stop, step = idx.indices(n)
+    else:
+        start, stop, step = idx.start, idx.stop, idx.step or 1
+        if start == None:
+            start = 0 if step > 0 else key
+        if stop == None:
+            stop = key + 1 if step > 0 else -1
+    if step > 0:
+        return start <= key < stop and (key - start) % step == 0
+    return stop < key <= start and (start - key) % -step == 0
+
+class PathPattern(object):
+    ''' compiled path pattern that finds substructs of an object without
+        visiting subtrees that cannot match
+
+        Parameters:
+        pattern - str or PathPattern, pattern of bracketed elements, each of
+            which is a field name ("spm"), an index (0), a set of field names
+            and/or indices ("temporal", "spatial" or 0, 2), an index range
+            (0:3 or ::2), any single key (*), or any number of keys (**)
+
+        Example:
+        A = {0: {'spm': {'util': {'disp': {'data': '<UNDEFINED>'}}}},
+             1: {'spm': {'spatial': {'realign': {'data': []}}}}}
+        pattern = PathPattern('[*]["spm"][**]["disp"]')
+        list(pattern.find(A))
+        [([0, 'spm', 'util', 'disp'], {'data': '<UNDEFINED>'})]
+        pattern.match([1, 'spm', 'util', 'disp'])
+        True
+
+        Note: Containers and values are found in depth-first order (the root
+        of A is never matched). Keys are compared by type, so "0" matches only
+        the field name '0' and 0 only the index (or dict key) 0. Negative
+        indices are resolved against the length of lists only.
+    '''
+    def __init__(self, pattern):
+        if isinstance(pattern, PathPattern):
+            pattern = pattern.pattern
+        self.pattern = pattern
+        element = '\\[((?:"[^"]*"|\'[^\']*\'|[^\\]])*)\\]'
+        if re.sub(element, '', pattern).strip() != '':
+            raise ValueError('invalid path pattern: {pattern}'.format(
+                pattern=pattern))
+        self.elements = [_parse_path_element(t)
+                         for t in re.findall(element, pattern)]
+
+    def _closure(self, states):
+        ''' add states reached by matching no keys with ** '''
+        stack = list(states)
+        states = set(states)
+        while len(stack) > 0:
+            pos = stack.pop()
+            if pos < len(self.elements) and self.elements[pos] == '**' and \
+                pos + 1 not in states:
+                states.add(pos + 1)
+                stack.append(pos + 1)
+        return states
+
+    def _step(self, states, key, n=None, negative=False):
+        ''' return states after matching key (of container with n keys, also
+            matching negative indices resolved against n if negative is True)
+        '''
+        out = set()
+        for pos in states:
+            if pos == len(self.elements):
+                continue
+            e = self.elements[pos]
+            if e == '**':
+                out.add(pos)
+            elif e == '*':
+                out.add(pos + 1)
+            elif isinstance(key, str):
+                if key in e[0]:
+                    out.add(pos + 1)
+            elif isinstance(key, (int, np.integer)) and \
+                not isinstance(key, bool):
+                if key in e[0] or (negative and key - n in e[0]) or \
+                    any([_in_slice(key, idx, n) for idx in e[1]]):
+                    out.add(pos + 1)
+        return self._closure(out)
+
+    def match(self, S):
+        ''' return True if substruct S matches pattern '''
+        states = self._closure([0])
+        for S_ in S:
+            states = self._step(states, S_)
+            if len(states) == 0:
+                return False
+        return len(self.elements) in states
+
+    def _keys(self, value, states):
+        ''' return keys of list to visit if only indices can match, or None
+            to visit all keys
+        '''
+        if type(value) != list:
+            return None
+        keys = set()
+        for pos in states:
+            if pos == len(self.elements):
+                continue
+            e = self.elements[pos]
+            if e in ('*', '**'):
+                return None
+            keys.update([k for k in e[0] if type(k) == int and
+                         -len(value) <= k < len(value)])
+            for idx in e[1]:
+                keys.update(range(*idx.indices(len(value))))
+        return sorted(set([k % len(value) for k in keys]))
+
+    def find(self, A, r=np.inf):
+        ''' yield (substruct, value) for each substruct of A matching pattern
+            (through levels r, see iter_substructs)
+        '''
+        n = len(self.elements)
+        stack = [([], A, self._closure([0]))]
+        while len(stack) > 0:
+            S, value, states = stack.pop()
+            if len(S) > 0 and n in states:
+                yield S, value
+            if len(S) > r or (len(states) == 1 and n in states):
+                continue
+            # get children that can still match
+            keys = self._keys(value, states)
+            if keys != None:
+                children = ((k, value[k]) for k in keys)
+            else:
+                children = _children(value)
+                if children == None:
+                    continue
+            try:
+                n_keys = len(value)
+            except TypeError:
+                n_keys = None
+            negative = type(value) == list
+            items = []
+            for S_, child in children:
+                states_ = self._step(states, S_, n_keys, negative)
+                if len(states_) > 0:
+                    items.append((S + [S_], child, states_))
+            stack.extend(reversed(items))
+
+def _has_child(value, S_):
+    ''' return True if S_ references an existing child of value as returned by
+        iter_substructs
+    '''
+    if type(value) == dict:
+        return S_ in value
+    if isinstance(S_, bool) or not isinstance(S_, (int, np.integer)):
+        return False
+    if type(value) == list or type(value) == tuple:
+        n = len(value)
+    elif type(value) == np.void:
+        n = len(value)
+    elif type(value).__module__ == np.__name__ and value.ndim > 0:
+        n = value.shape[0]
+    else:
+        return False
+    return 0 <= S_ < n
+
+class PathIndex(object):
+    ''' reusable index of substructs, string representations, and values of an
+        object for repeated pebl_getfield/pebl_setfield calls
+
+        Parameters:
+        A - object, object to index (referenced, not copied)
+        r - number, number of levels to index (see struct2sub)
+            [default is np.inf]
+
+        Attributes:
+        A - object, indexed object
+        S - list, substructs for each value in A (see struct2sub)
+        R - list, string representations for each substruct in S
+        C - list, values in A referenced by each substruct in S (not copied)
+
+        Example:
+        A = {0: {'spm': {'util': {'disp': {'data': '<UNDEFINED>'}}}}}
+        index = PathIndex(A)
+        C, S, R = pebl_getfield(index, expr='.*\["disp"]')
+        index = pebl_setfield(index, './mri/anatomical.nii',
+            R='[0]["spm"]["util"]["disp"]["data"]')
+        index.A =
+        {0: {'spm': {'util': {'disp': {'data': './mri/anatomical.nii'}}}}}
+
+        Note: pebl_setfield sets values in index.A in place and updates only
+        the entries beneath the paths that were set. If A is changed by other
+        means, call invalidate() so that the index is rebuilt when next used.
+    '''
+    def __init__(self, A, r=np.inf):
+        self.A = A
+        self.r = r
+        self.build()
+
+    def build(self):
+        ''' (re)build index from all substructs of A '''
+        self.S = []
+        self.R = []
+        self.C = []
+        for S_, C_ in iter_substructs(self.A, self.r):
+            self.S.append(S_)
+            self.R.append(sub2str(S_))
+            self.C.append(C_)
+        self._update_lookup()
+
+    def invalidate(self):
+        ''' mark index as out of date (rebuilt on next use) '''
+        self._lookup = None
+
+    def _update_lookup(self):
+        self._lookup = dict((R_, i) for i, R_ in enumerate(self.R))
+
+    def _check(self):
+        if self._lookup == None:
+            self.build()
+
+    def get(self, R_):
+        ''' return substruct and (uncopied) value for string representation R_
+
+            Parameters:
+            R_ - str, string representation of value in A
+
+            Returns:
+            S_ - list, substruct for R_
+            C_ - any, value in A at S_
+        '''
+        self._check()
+        i = self._lookup.get(R_)
+        if i != None:
+            return self.S[i], self.C[i]
+        S_ = sub2str(R_)
+        return S_, subsref(self.A, S_, 'none')
+
+    def find(self, expr=None, prefix=None, fun=None):
+        ''' return indexed values matching regex, prefix, and/or function
+
+            Parameters:
+            expr - str or list, regular expression(s) to match within R (see
+                pebl_getfield)
+                [default is None]
+            prefix - list or str, substruct or string representation that
+                returned paths must begin with
+                [default is None]
+            fun - function, function returning True for values to return
+                [default is None]
+
+            Returns:
+            C - list, values in A (not copied)
+            S - list, substructs for each value
+            R - list, string representations for each value
+        '''
+        self._check()
+        R = list(self.R)
+        if prefix != None:
+            if type(prefix) != str:
+                prefix = sub2str(prefix)
+            R = [R_ for R_ in R if R_.startswith(prefix)]
+        if expr != None:
+            if type(expr) not in (list, tuple):
+                expr = [expr,]
+            fnd = set()
+            for e in expr:
+                e = compile_pattern(e)
+                for R_ in R:
+                    m = e.findall(R_)
+                    if len(m) > 0:
+                        fnd.add(m[0])
+            R = sorted(fnd)
+        S = []
+        C = []
+        for R_ in R:
+            S_, C_ = self.get(R_)
+            S.append(S_)
+            C.append(C_)
+        if fun != None:
+            fnd = [bool(fun(C_)) for C_ in C]
+            C = [C_ for C_, f in zip(C, fnd) if f]
+            S = [S_ for S_, f in zip(S, fnd) if f]
+            R = [R_ for R_, f in zip(R, fnd) if f]
+        return C, S, R
+
+    def setfield(self, S, C):
+        ''' set values in A in place and update index beneath each substruct
+
+            Parameters:
+            S - list, substructs to set values in A
+            C - list, values to set at each substruct in S
+
+            Returns:
+            None
+        '''
+        self._check()
+        # find substructs that will change before setting values
+        roots = []
+        for S_ in S:
+            value = self.A
+            for i, S1 in enumerate(S_):
+                if not _has_child(value, S1):
+                    S_ = S_[:i]
+                    break
+                value = value[S1]
+            if len(S_) > self.r:
+                S_ = S_[:int(self.r)]
+            roots.append(list(S_))
+        # set values in A
+        self.A = _set_paths(self.A, S, C)
+        # rebuild entire index if root changed
+        if [] in roots:
+            self.build()
+            return
+        # keep only roots not within other roots
+        roots = sorted(roots, key=len)
+        tmp = []
+        for S_ in roots:
+            if not any(S_[:len(t)] == t for t in tmp):
+                tmp.append(S_)
+        roots = tmp
+        prefixes = tuple([sub2str(S_) for S_ in roots])
+        # replace entries beneath each root with new entries
+        done = [False] * len(roots)
+        S_out = []
+        R_out = []
+        C_out = []
+        def add_root(j):
+            done[j] = True
+            node = subsref(self.A, roots[j], 'none')
+            for S_, C_ in iter_substructs(node, self.r - len(roots[j])):
+                S_out.append(roots[j] + S_)
+                R_out.append(sub2str(roots[j] + S_))
+                C_out.append(C_)
+        for S_, R_, C_ in zip(self.S, self.R, self.C):
+            if not R_.startswith(prefixes):
+                S_out.append(S_)
+                R_out.append(R_)
+                C_out.append(C_)
+                continue
+            j = [j for j, p in enumerate(prefixes) if R_.startswith(p)][0]
+            if not done[j]:
+                add_root(j)
+        for j in range(len(roots)):
+            if not done[j]:
+                add_root(j)
+        self.S = S_out
+        self.R = R_out
+        self.C = C_out
+        self._update_lookup()
+
+class PersistentStruct(object):
+    ''' immutable object whose updates return new versions sharing all
+        unchanged containers with previous versions
+
+        Parameters:
+        A - object, object to store (deep copied unless copy_value is False)
+        copy_value - bool, deep copy A (set to False only if A is not
+            referenced elsewhere)
+            [default is True]
+
+        Attributes:
+        A - object, stored object (shared between versions, do not modify)
+
+        Example:
+        template = PersistentStruct({0: {'spm': {'util': {'disp':
+            {'data': '<UNDEFINED>'}}}}})
+        subj1 = pebl_setfield(template, './sub1/anat.nii',
+            R='[0]["spm"]["util"]["disp"]["data"]')
+        subj1.thaw() =
+        {0: {'spm': {'util': {'disp': {'data': './sub1/anat.nii'}}}}}
+        template.thaw() =
+        {0: {'spm': {'util': {'disp': {'data': '<UNDEFINED>'}}}}}
+
+        Note: Each update copies only the containers along the paths that are
+        set (see pebl_setfield with copy_mode='path'), so N versions of a
+        template use the memory of the template plus the changed paths.
+        Indexing returns a PersistentStruct for containers and values
+        otherwise; use thaw() to return a plain (deep copied) object.
+    '''
+    __slots__ = ('A',)
+
+    def __init__(self, A, copy_value=True):
+        if isinstance(A, PersistentStruct):
+            A = A.A
+        elif copy_value:
+            A = copy.deepcopy(A)
+        self.A = A
+
+    def setfield(self, S, C):
+        ''' return new version with each value in C set at each substruct in S
+            (values in C are not copied)
+        '''
+        return PersistentStruct(_set_paths(self.A, S, C, 'path'), False)
+
+    def get(self, S):
+        ''' return value at substruct or string representation S '''
+        if isinstance(S, str):
+            S = sub2str(S)
+        return self._wrap(subsref(self.A, S, 'none'))
+
+    def thaw(self):
+        ''' return deep copy of stored object '''
+        return copy.deepcopy(self.A)
+
+    @staticmethod
+    def _wrap(value):
+        if _children(value) != None or type(value) in [dict, list]:
+            return PersistentStruct(value, False)
+        return value
+
+    def __getitem__(self, key):
+        return self._wrap(_getitem(self.A, key))
+
+    def __len__(self):
+        return len(self.A)
+
+    def __iter__(self):
+        return iter(self.A)
+
+    def __contains__(self, key):
+        return key in self.A
+
+    def __eq__(self, other):
+        if isinstance(other, PersistentStruct):
+            other = other.A
+        # compare structures, skipping shared containers (see pebl_diff)
+        return not _diff_node(self.A, other, [], np.inf, None)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return 'PersistentStruct({A})'.format(A=repr(self.A))
+
+def _fun_mask(fun, C):
+    ''' evaluate function dict (see pebl_getfield) for each value in C
 
-def pebl_getfield(A, S=None, R=None, expr=None, fun=None, r=np.inf):
+        Parameters:
+        fun - dict, dict containing 'fun', integer argument indices, and
+            optionally 'vectorize' (see pebl_getfield)
+        C - list, values to evaluate
+
+        Returns:
+        fnd - ndarray, boolean array that is True where fun returned True
+    '''
+    # set fnd array of false
+    fnd = np.zeros(len(C), dtype=np.bool)
+    # get key positions for function call
+    key_ns = [k for k in fun.keys() if type(k) == int]
+    c_idx = [k for k in range(len(key_ns)) if k not in key_ns]
+    if len(c_idx) == 0:
+        c_idx = len(key_ns)
+    else:
+        c_idx = c_idx[0]
+    args = [fun.get(k) for k in range(max(key_ns + [c_idx]) + 1)]
+    # evaluate numeric scalars in one call per dtype
+    vectorize = fun.get('vectorize')
+    if vectorize == None:
+        vectorize = isinstance(fun['fun'], np.ufunc) or fun['fun'] is np.isclose
+    other_args = [a for k, a in enumerate(args) if k != c_idx]
+    if vectorize and all(np.ndim(a) == 0 for a in other_args):
+        groups = {}
+        for i, C_ in enumerate(C):
+            if isinstance(C_, (bool, int, float, complex, np.number, np.bool_)):
+                groups.setdefault(np.asarray(C_).dtype, []).append(i)
+        done = np.zeros(len(C), dtype=np.bool)
+        for dtype, idx in groups.items():
+            if dtype.kind not in 'biufc':
+                continue
+            args[c_idx] = np.array([C[i] for i in idx], dtype=dtype)
+            tmp = fun['fun'](*args)
+            if tmp is NotImplemented or np.shape(tmp) != (len(idx),):
+                continue
+            fnd[idx] = tmp
+            done[idx] = True
+    else:
+        done = np.zeros(len(C), dtype=np.bool)
+    # for each remaining C_ evaluate function
+    for i in np.where(np.invert(done))[0]:
+        args[c_idx] = C[i]
+        tmp = fun['fun'](*args)
+        if tmp is NotImplemented:
+            fnd[i] = False
+        else:
+            fnd[i] = tmp
+    return fnd
+
+def pebl_getfield(A, S=None, R=None, expr=None, fun=None, r=np.inf,
+                  group=False, return_type='list', path=None):
     ''' get values from object, A, using substructs or string representations
 
         Parameters:
-        A - object, object to return values from
+        A - object, PathIndex, MatView, or PersistentStruct, object to return
+            values from (if PathIndex, indexed string representations are
+            searched rather than re-searching A and r is ignored; if MatView,
+            only values at S or R are converted unless searching all
+            substructs)
         Options:
         S - list, substruct to get value from A
             [defualt is None]
         R - list or str, string representation to get value from A
             [default is None]
-        expr - str, expression to search string representations to get value
-            from A
+        expr - str, compiled pattern, or list, expression(s) to search string
+            representations to get value from A (string representations
+            matching any expression are returned unless group is True)
             [default is None]
         fun - dict, dict containing function to search for values within A. keys
             within the dict should contain 'fun', and integers corresponding to
             argument index (see Example 2). Each C will be input as the argument
             not contained in the dict keys (i.e. at index 0 for Example 2).
+            Optionally, 'vectorize' may be set to evaluate all numeric scalar
+            values of each dtype in a single call (default is True for numpy
+            ufuncs and np.isclose, other values are evaluated one at a time).
             [default is None]
         r - int, number of level to search within A (each level is field or
             index reference)
             [default is np.inf]
+        group - bool, return C, S, and R as dicts of results for each
+            expression in expr
+            [default is False]
+        return_type - str, 'list' to return C, S, and R as lists or 'array' to
+            return 1-d object arrays
+            [default is 'list']
+        path - str or PathPattern, path pattern to find substructs in A without
+            searching subtrees that cannot match (see PathPattern)
+            [default is None]
 
         Returns:
         C - list, values returned from A
             (i.e. C[0] == subsref(A, S[0]) or eval('A' + R[0]))
         S - list, substructs used to return values from A
         R - list, string representations used to return values from A
+            (if group is True, C, S, and R are dicts of expression: list)
 
         Example 1:
         A = {0: {'spm': {'util': {'disp': {'data': '<UNDEFINED>'}}}}}
@@ -420,54 +1994,105 @@ def pebl_getfield(A, S=None, R=None, expr=None, fun=None, r=np.inf):
         [['test1', 0], ['test2', 1]]
         R =
         ['["test1"][0]', '["test2"][1]']
+
+        Example 3:
+        A = {0: {'spm': {'util': {'disp': {'data': '<UNDEFINED>'}}}}}
+        C, S, R = pebl_getfield(A, path='[*]["spm"][**]["disp"]')
+        S =
+        [[0, 'spm', 'util', 'disp']]
     '''
-    # if S exists, get copy
-    if S != None:
-        if type(S)!=list or type(S[0])!=list:
-            S = [S,]
-        else:
-            S = list(S)
-    else: # get substructs of A
-        S = []
-        if not np.iterable(r):
-            r = [r,]
-        for rr in r:
-            S = S + struct2sub(A, rr)
-    # if R exists, update S
-    if R != None:
-        if not np.iterable(R):
-            R = [R,]
-        else:
-            R = list(R)
-        S = []
-        for R_ in R:
-            S.append(sub2str(R_))
-    else: # if R doesnt exist, set from S
-        R = []
-        for S_ in S:
-            R.append(sub2str(S_))
+    # use PathIndex if input
+    index = None
+    if isinstance(A, PathIndex):
+        index = A
+        A = index.A
+    elif isinstance(A, PersistentStruct):
+        A = A.A
+    # convert lazy view if searching all substructs
+    if isinstance(A, MatView) and S == None and R == None:
+        A = A.convert()
+    # get string representations from index
+    if index != None and S == None and R == None and path == None:
+        _, _, R = index.find()
+    else:
+        # if S exists, get copy
+        if S != None:
+            if type(S)!=list or type(S[0]) not in (list, SubPath):
+                S = [S,]
+            else:
+                S = list(S)
+        elif R == None and path != None: # get substructs matching path
+            if np.iterable(r):
+                r = max(r)
+            S = [S_ for S_, _ in PathPattern(path).find(A, r)]
+        elif R == None: # get substructs of A
+            S = []
+            if not np.iterable(r):
+                r = [r,]
+            for rr in r:
+                S.extend([S_ for S_, _ in iter_substructs(A, rr)])
+        # if R exists, update S
+        if R != None:
+            if isinstance(R, str) or not np.iterable(R):
+                R = [R,]
+            else:
+                R = list(R)
+            S = []
+            for R_ in R:
+                S.append(sub2str(R_))
+        else: # if R doesnt exist, set from S
+            R = []
+            for S_ in S:
+                R.append(sub2str(S_))
     # find R using regex
     if expr != None:
         tmp = list(R)
         R = []
         # copy expr
-        if type(expr) == str:
+        if type(expr) not in (list, tuple):
             expr = [expr,]
         else:
             expr = list(expr)
+        # skip string representations matching no expression in one pass
+        if len(expr) > 1:
+            pattern = _combine(expr)
+            if pattern != None:
+                if _stats != None:
+                    _count('regex', len(tmp))
+                tmp = [R_ for R_ in tmp if pattern.search(R_) != None]
+        # collect unique sorted matches for each expression
+        R_e = []
         for e in expr:
-            m = [re.findall(e, R_) for R_ in tmp]
-            m = np.unique([m[0] for m in m if len(m) > 0])
-            R = np.append(R, m)
-        R = np.unique(R).tolist()
-    # update S
+            if _stats != None:
+                _count('regex', len(tmp))
+            m = set()
+            findall = compile_pattern(e).findall
+            for R_ in tmp:
+                m_ = findall(R_)
+                if len(m_) > 0:
+                    m.add(m_[0])
+            R_e.append(sorted(m))
+        R = sorted(set().union(*R_e))
+        # get values for each expression
+        if group:
+            if index != None:
+                A = index
+            C, S, R = {}, {}, {}
+            for e, R_ in zip(expr, R_e):
+                C[e], S[e], R[e] = pebl_getfield(A, R=R_, fun=fun,
+                    return_type=return_type)
+            return C, S, R
+    # update S and use subsref to get values
     S = []
-    for R_ in R:
-        S.append(sub2str(R_))
-    # use subsref to get values
     C = []
-    for S_ in S:
-        C.append(subsref(A, S_))
+    for R_ in R:
+        if index != None:
+            S_, C_ = index.get(R_)
+        else:
+            S_ = sub2str(R_)
+            C_ = subsref(A, S_, 'none')
+        S.append(list(S_))
+        C.append(copy.deepcopy(C_))
     # search using function
     if fun != None:
         # copy fun
@@ -475,40 +2100,24 @@ def pebl_getfield(A, S=None, R=None, expr=None, fun=None, r=np.inf):
             fun = {'fun': fun}
         else:
             fun = dict(fun)
-        # set fnd array of false
-        fnd = np.zeros(len(C), dtype=np.bool)
-        # get key positions for function call
-        key_ns = [k for k in fun.keys() if type(k) == int]
-        key_rng = range(np.max(key_ns)+1)
-        c_idx = [k for k in key_rng if k not in key_ns]
-        if len(c_idx) == 0:
-            c_idx = np.max(key_ns)+1
-        else:
-            c_idx = c_idx[0]
-        # for each C_ evalutate function
-        for i, C_ in enumerate(C):
-            # set c_idx to C_
-            fun[c_idx] = C_
-            # set args for input
-            args = [fun[k] for k in key_rng]
-            # evaluate function
-            tmp = fun['fun'](*args)
-            if tmp == NotImplemented:
-                fnd[i] = False
-            else:
-                fnd[i] = tmp
+        # evaluate function for each value
+        fnd = _fun_mask(fun, C)
         # set to true indices
-        C = np.array(C, dtype=np.object)[fnd].tolist()
-        S = np.array(S, dtype=np.object)[fnd].tolist()
-        R = np.array(R, dtype=np.object)[fnd].tolist()
+        C = [C_ for C_, f in zip(C, fnd) if f]
+        S = [S_ for S_, f in zip(S, fnd) if f]
+        R = [R_ for R_, f in zip(R, fnd) if f]
     # return C, S, R
-    return C, S, R
+    return tuple([_return_type(x, return_type) for x in [C, S, R]])
 
-def pebl_setfield(A, C, S=None, R=None, expr=None, fun=None, r=np.inf):
+def pebl_setfield(A, C, S=None, R=None, expr=None, fun=None, r=np.inf,
+                  copy_mode='deep', path=None):
     ''' set values in object, A, using substructs or string representations
 
         Parameters:
-        A - object, object to set values
+        A - object, PathIndex, or PersistentStruct, object to set values (if
+            PathIndex, values are set in A.A in place and the index is updated;
+            if PersistentStruct, a new version is returned and copy_mode is
+            ignored)
         C - list, list of values to set in A
         S - list, substructs referencing location to set values in A
             [default is None]
@@ -520,9 +2129,17 @@ def pebl_setfield(A, C, S=None, R=None, expr=None, fun=None, r=np.inf):
             [defualt is None]
         r - int, number of levels in A to search if S or R are not set directly
             [default is np.inf]
+        copy_mode - str, 'deep' to set values in a deep copy of A, 'path' to
+            copy only the containers along S (see subsasgn), or 'none' to set
+            values in A in place
+            [default is 'deep']
+        path - str or PathPattern, path pattern to find locations in A to set
+            values
+            [default is None]
 
         Returns:
-        A - object, updated object with values set
+        A - object, PathIndex, or PersistentStruct, updated object with values
+            set
 
         Note:
         See pebl_getfield for further description on Parameters.
@@ -539,7 +2156,7 @@ def pebl_setfield(A, C, S=None, R=None, expr=None, fun=None, r=np.inf):
         C = list(C)
     # if no S and no R, set from A using pebl_getfield
     if S==None and R==None:
-        _, S, R = pebl_getfield(A, expr=expr, fun=fun, r=r)
+        _, S, R = pebl_getfield(A, expr=expr, fun=fun, r=r, path=path)
     # check for S and R separately
     if R==None:
         R = []
@@ -551,7 +2168,7 @@ def pebl_setfield(A, C, S=None, R=None, expr=None, fun=None, r=np.inf):
         S = []
         for R_ in R:
             S.append(sub2str(R_))
-    elif type(S)!=list or type(S[0])!=list: # make iterable
+    elif type(S)!=list or type(S[0]) not in (list, SubPath): # make iterable
         S = [S,]
     else: # copy
         S = list(S)
@@ -561,29 +2178,746 @@ def pebl_setfield(A, C, S=None, R=None, expr=None, fun=None, r=np.inf):
     elif len(C) != len(S):
         C = C[:np.min([len(C),len(S)])]
         S = S[:np.min([len(C),len(S)])]
-    # init R for output
-    R = []
-    for C_, S_ in zip(C, S):
-        # update R
-        R.append(sub2str(S_))
-        # set A
-        A = subsasgn(A, S_, C_)
-    return A
+    # set values through index
+    if isinstance(A, PathIndex):
+        A.setfield(S, [copy.deepcopy(C_) for C_ in C])
+        return A
+    # return new version sharing unchanged containers
+    if isinstance(A, PersistentStruct):
+        return A.setfield(S, [copy.deepcopy(C_) for C_ in C])
+    if copy_mode not in ('deep', 'path', 'none'):
+        raise ValueError('unknown copy_mode: {mode}'.format(mode=copy_mode))
+    # copy A once, then set values in place
+    if copy_mode == 'deep':
+        A = copy.deepcopy(A)
+        copy_mode = 'none'
+    # set all values in one traversal (copy C_ so repeated values are not
+    # shared)
+    return _set_paths(A, S, [copy.deepcopy(C_) for C_ in C], copy_mode)
+
+def _same_leaf(a, b):
+    ''' return True if values a and b (of the same type) are equal '''
+    try:
+        if bool(a == b):
+            return True
+    except (ValueError, TypeError):
+        pass
+    # equal nan values, etc.
+    return repr(a) == repr(b)
+
+def _diff_node(a, b, path, r, out):
+    ''' walk a and b together, appending (substruct, value in b) pairs to the
+        'added', 'removed', and 'changed' lists in out (see pebl_diff), and
+        return True if a and b differ (if out is None, stop at the first
+        difference)
+    '''
+    # skip shared subtrees
+    if a is b:
+        return False
+    keys = None
+    if type(a) != type(b):
+        differ = True
+    elif type(a) == dict:
+        keys = [k for k in a.keys() if k in b]
+        added = [k for k in b.keys() if k not in a]
+        removed = [k for k in a.keys() if k not in b]
+    elif type(a) == list or type(a) == tuple:
+        n = min(len(a), len(b))
+        keys = range(n)
+        added = range(n, len(b))
+        removed = range(n, len(a))
+    elif type(a) == np.ndarray:
+        if a.dtype != b.dtype or a.shape != b.shape:
+            differ = True
+        # compare data by buffer
+        elif not a.dtype.hasobject:
+            differ = a.tobytes() != b.tobytes()
+        elif a.dtype.names == None and a.ndim > 0:
+            keys = range(a.shape[0])
+            added = removed = []
+        else:
+            differ = pebl_hash(a) != pebl_hash(b)
+    elif type(a) == np.void:
+        differ = pebl_hash(a) != pebl_hash(b)
+    else:
+        differ = not _same_leaf(a, b)
+    # compare containers within tuples or below level r as a whole
+    if keys != None and (out == None or len(path) > r or type(a) == tuple):
+        differ = len(added) > 0 or len(removed) > 0 or \
+            any(_diff_node(a[k], b[k], None, r, None) for k in keys)
+    elif keys != None:
+        differ = False
+        for k in keys:
+            differ = _diff_node(a[k], b[k], path + [k], r, out) or differ
+        for k in added:
+            out['added'].append((path + [k], b[k]))
+        for k in removed:
+            out['removed'].append((path + [k], None))
+        return differ or len(added) > 0 or len(removed) > 0
+    if differ and out != None:
+        out['changed'].append((path, b))
+    return differ
+
+def pebl_diff(A, B, r=np.inf):
+    ''' return paths that differ between A and B in one walk of both objects
+
+        Parameters:
+        A - object or PersistentStruct, object to compare from
+        B - object or PersistentStruct, object to compare to
+        r - int, number of levels to compare separately (see struct2sub);
+            containers below level r are reported as changed as a whole
+            [default is np.inf]
+
+        Returns:
+        diff - dict, 'added' (string representations in B but not A),
+            'removed' (string representations in A but not B), 'changed'
+            (string representations in both A and B with different values),
+            and 'values' (dict of string representation: value in B for each
+            added or changed path, not copied)
+
+        Example:
+        A = {0: {'spm': {'data': '<UNDEFINED>', 'so': [1, 2]}}}
+        B = {0: {'spm': {'data': './a.nii', 'so': [1, 2, 3]}}, 1: {}}
+        diff = pebl_diff(A, B)
+        diff =
+        {'added': ['[0]["spm"]["so"][2]', '[1]'], 'removed': [],
+         'changed': ['[0]["spm"]["data"]'],
+         'values': {'[0]["spm"]["so"][2]': 3, '[1]': {},
+                    '[0]["spm"]["data"]': './a.nii'}}
+
+        Note: Subtrees shared by A and B (e.g., unchanged containers of
+        PersistentStruct versions) are skipped without being walked, and
+        ndarrays without objects are compared by buffer and reported as
+        changed as a whole. Values that differ in type, and tuples, are also
+        reported as changed as a whole. Removed list indices are always the
+        last indices of the list in A.
+    '''
+    # compare stored/converted objects
+    if isinstance(A, PersistentStruct):
+        A = A.A
+    elif isinstance(A, MatView):
+        A = A.convert()
+    if isinstance(B, PersistentStruct):
+        B = B.A
+    elif isinstance(B, MatView):
+        B = B.convert()
+    out = {'added': [], 'removed': [], 'changed': []}
+    _diff_node(A, B, [], r, out)
+    # convert substructs to string representations
+    diff = {'values': {}}
+    for k in ['added', 'removed', 'changed']:
+        diff[k] = []
+        for S_, value in out[k]:
+            R_ = sub2str(S_)
+            diff[k].append(R_)
+            if k != 'removed':
+                diff['values'][R_] = value
+    return diff
+
+def pebl_patch(A, diff, copy_mode='deep'):
+    ''' apply differences from pebl_diff to A in one batched write
+
+        Parameters:
+        A - object or PersistentStruct, object to update (if PersistentStruct,
+            a new version is returned and copy_mode is ignored)
+        diff - dict, differences returned from pebl_diff
+        copy_mode - str, 'deep' to update a deep copy of A, 'path' to copy
+            only the containers along changed paths (see subsasgn), or 'none'
+            to update A in place
+            [default is 'deep']
+
+        Returns:
+        A - object or PersistentStruct, updated object (equal to the B passed
+            to pebl_diff if A is equal to its A)
+
+        Example:
+        diff = pebl_diff(old_batch, new_batch)
+        batch = pebl_patch(batch, diff)
+
+        Note: Added and changed values are deep copied from diff['values'].
+    '''
+    if copy_mode not in ('deep', 'path', 'none'):
+        raise ValueError('unknown copy_mode: {mode}'.format(mode=copy_mode))
+    # replace A if it differs as a whole
+    root = sub2str([])
+    if root in diff['changed']:
+        A_ = copy.deepcopy(diff['values'][root])
+        if isinstance(A, PersistentStruct):
+            return PersistentStruct(A_, False)
+        return A_
+    # set added/changed values, then remove paths
+    R = diff['changed'] + diff['added']
+    C = [copy.deepcopy(diff['values'][R_]) for R_ in R]
+    R = R + diff['removed'][::-1]
+    C = C + [_REMOVE] * len(diff['removed'])
+    S = [sub2str(R_) for R_ in R]
+    if isinstance(A, PersistentStruct):
+        return PersistentStruct(_set_paths(A.A, S, C, 'path'), False)
+    # copy A once, then update in place
+    if copy_mode == 'deep':
+        A = copy.deepcopy(A)
+        copy_mode = 'none'
+    return _set_paths(A, S, C, copy_mode)
+
+def _combine(expr, each=False):
+    ''' return compiled pattern combining each expression in expr as a named
+        group (_e0, _e1, ...), or None if expressions cannot be combined (i.e.,
+        an expression contains a backreference or global inline flags, or is
+        invalid when combined)
+
+        If each is False, the pattern matches the first expression found
+        (alternation). If each is True, the pattern matches the start of a
+        string, setting the group for every expression that matches there
+        (see _match_each).
+    '''
+    expr = [_pattern_str(e) for e in expr]
+    if None in expr:
+        return None
+    text = [e if isinstance(e, str) else e.decode('utf-8', 'replace')
+            for e in expr]
+    # global flags (e.g., '(?i)') would apply to every expression
+    if any([re.search(r'\\[1-9]|\(\?P=|\(\?[aiLmsux]+\)', e) != None
+            for e in text]):
+        return None
+    # optional lookaheads in sequence or alternation of groups
+    if each:
+        parts = ['(?:(?=(?P<_e%d>', ')))?', '']
+    else:
+        parts = ['(?P<_e%d>', ')', '|']
+    if isinstance(expr[0], str):
+        pattern = parts[2].join([parts[0] % n + e + parts[1]
+                                 for n, e in enumerate(expr)])
+    else: # bytes
+        parts = [p.encode('utf-8') for p in parts]
+        pattern = parts[2].join([parts[0].replace(b'%d', str(n).encode(
+            'utf-8')) + e + parts[1] for n, e in enumerate(expr)])
+    try:
+        return compile_pattern(pattern)
+    except re.error:
+        return None
+
+def _match_each(expr, pattern, name):
+    ''' return indices of expressions in expr matching the start of name '''
+    if pattern == None:
+        return [n for n, e in enumerate(expr)
+                if compile_pattern(e).match(name) != None]
+    m = pattern.match(name)
+    return [n for n in range(len(expr)) if m.group('_e%d' % n) != None]
+
+def _search_each(expr, txt, idx=None, pos=0):
+    ''' return sorted indices (from idx) of expressions in expr found in txt
+        (from index pos), searching txt with the combined expressions not yet
+        found
+    '''
+    if idx == None:
+        idx = range(len(expr))
+    idx = list(idx)
+    fnd = []
+    while len(idx) > 0:
+        pattern = _combine([expr[n] for n in idx])
+        if pattern == None:
+            fnd.extend([n for n in idx
+                        if compile_pattern(expr[n]).search(txt, pos) != None])
+            break
+        m = pattern.search(txt, pos)
+        if m == None:
+            break
+        # remove expression found first
+        for i, n in enumerate(idx):
+            if m.group('_e%d' % i) != None:
+                fnd.append(idx.pop(i))
+                break
+    return sorted(fnd)
+
+def _list_dir(folder):
+    ''' return names and directory flags for entries in folder '''
+    # use scandir to avoid a stat call per entry
+    if hasattr(os, 'scandir'):
+        names = []
+        dir_tf = []
+        for entry in os.scandir(folder):
+            names.append(entry.name)
+            try:
+                dir_tf.append(entry.is_dir())
+            except OSError:
+                dir_tf.append(False)
+        return names, dir_tf
+    names = os.listdir(folder)
+    return names, [os.path.isdir(os.path.join(folder,n)) for n in names]
+
+def _stat_key(filename):
+    ''' return [mtime, size, inode] used to check whether filename changed '''
+    st = os.stat(filename)
+    return [st.st_mtime, st.st_size, st.st_ino]
+
+class SearchCache(object):
+    ''' on-disk cache of directory listings and file text search results used
+        by pebl_search/iter_search
+
+        Parameters:
+        filename - str, json file to load cache from and save cache to
+            [default is None, cache is kept in memory only]
+        max_entries - int, maximum number of directories and files to keep
+            (least recently used entries are evicted as entries are added)
+            [default is None]
+        max_age - number, maximum time (in seconds) since an entry was last
+            used before it is evicted when saved
+            [default is None]
+
+        Attributes:
+        dirs - OrderedDict, cached listing of each directory (from least to
+            most recently used)
+        files - OrderedDict, cached search results of each file (from least
+            to most recently used)
+        counts - dict, number of hits and misses for directories and files
+
+        Example:
+        cache = SearchCache('search_cache.json', max_age=7*24*3600)
+        files = pebl_search(folder, 'rp_', '.*\.txt$', cache=cache)
+        cache.save()
+        cache.counts =
+        {'dir_hits': 120, 'dir_misses': 2, 'file_hits': 3480, 'file_misses': 11}
+
+        Note: Entries are reused only if the mtime, size, and inode of the
+        directory/file are unchanged.
+    '''
+    def __init__(self, filename=None, max_entries=None, max_age=None):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.dirs = collections.OrderedDict()
+        self.files = collections.OrderedDict()
+        self.reset_counts()
+        if filename != None and os.path.isfile(filename):
+            with open(filename, 'r') as f:
+                data = json.load(f)
+            # order entries from least to most recently used
+            for d, k in ((self.dirs, 'dirs'), (self.files, 'files')):
+                entries = data.get(k, {})
+                d.update(sorted(entries.items(),
+                    key=lambda item: item[1].get('time', 0)))
+            self._limit()
+
+    def reset_counts(self):
+        ''' set hit/miss counts to zero '''
+        self.counts = {'dir_hits': 0, 'dir_misses': 0, 'file_hits': 0,
+            'file_misses': 0}
+
+    def list_dir(self, folder):
+        ''' return names and directory flags for entries in folder, listing
+            folder only if it has changed
+        '''
+        st = _stat_key(folder)
+        entry = self.dirs.pop(folder, None)
+        if entry != None and entry['stat'] == st:
+            self.counts['dir_hits'] += 1
+        else:
+            self.counts['dir_misses'] += 1
+            names, dir_tf = _list_dir(folder)
+            entry = {'stat': st, 'names': names, 'dir_tf': dir_tf}
+        # move entry to most recently used
+        entry['time'] = time.time()
+        self.dirs[folder] = entry
+        self._limit()
+        return entry['names'], entry['dir_tf']
 
-def pebl_search(folder, expr, ftype, n_levels=np.inf, verbose=False):
+    def get_match(self, filename, st, key):
+        ''' return cached search result for filename and key (or None) '''
+        entry = self.files.get(filename)
+        if entry == None or entry['stat'] != st or \
+            key not in entry['matches']:
+            return None
+        # move entry to most recently used
+        entry['time'] = time.time()
+        self.files[filename] = self.files.pop(filename)
+        return entry['matches'][key]
+
+    def set_match(self, filename, st, key, fnd):
+        ''' store search result for filename and key '''
+        entry = self.files.pop(filename, None)
+        if entry == None or entry['stat'] != st:
+            entry = {'stat': st, 'matches': {}}
+        entry['matches'][key] = fnd
+        entry['time'] = time.time()
+        self.files[filename] = entry
+        self._limit()
+
+    def invalidate(self, path=None):
+        ''' remove entries for path and its subfolders (or all entries) '''
+        if path == None:
+            self.dirs.clear()
+            self.files.clear()
+            return
+        path = os.path.abspath(path)
+        for d in (self.dirs, self.files):
+            for k in list(d.keys()):
+                if k == path or k.startswith(os.path.join(path, '')):
+                    d.pop(k)
+
+    def evict(self):
+        ''' remove entries older than max_age and least recently used entries
+            beyond max_entries
+        '''
+        if self.max_age != None:
+            t = time.time() - self.max_age
+            for d in (self.dirs, self.files):
+                for k in list(d.keys()):
+                    if d[k].get('time', 0) < t:
+                        d.pop(k)
+        self._limit()
+
+    def _limit(self):
+        # remove least recently used entries beyond max_entries
+        if self.max_entries == None:
+            return
+        while len(self.dirs) + len(self.files) > max(self.max_entries, 0):
+            if len(self.files) == 0:
+                d = self.dirs
+            elif len(self.dirs) == 0:
+                d = self.files
+            else:
+                t = [next(iter(d.values())).get('time', 0)
+                     for d in (self.dirs, self.files)]
+                d = self.dirs if t[0] <= t[1] else self.files
+            d.popitem(last=False)
+
+    def save(self, filename=None):
+        ''' evict entries and save cache to filename (or self.filename) '''
+        if filename == None:
+            filename = self.filename
+        if filename == None:
+            raise ValueError('no filename to save cache')
+        self.evict()
+        # write to temporary file, then replace
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'dirs': self.dirs, 'files': self.files}, f)
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmp, filename)
+
+def _walk_search(folder, expr, ftype, n_levels=np.inf, verbose=False,
+                 cache=None):
+    ''' walk folder and yield names matching expr (if ftype is 'dir') or files
+        matching ftype whose text should be searched for expr. If ftype is
+        'dir' and expr is a list, yield (indices of expressions matched, name).
+    '''
+    multi = type(expr) == list
+    if multi and ftype == 'dir':
+        pattern = _combine(expr, True)
+    elif ftype == 'dir':
+        match = _name_matcher(expr)
+    else:
+        match = _name_matcher(ftype)
+    stack = [(os.path.abspath(folder), n_levels)]
+    is_root = True
+    while len(stack) > 0:
+        folder, n_levels = stack.pop()
+        # print each subfolder searched
+        if verbose and not is_root:
+            print('Searching {dir}'.format(dir=os.path.basename(folder)))
+        is_root = False
+        if cache != None:
+            names, dir_tf = cache.list_dir(folder)
+        else:
+            names, dir_tf = _list_dir(folder)
+        if _stats != None:
+            _count('dirs_listed')
+            _count('files_listed', len(names))
+            _count('regex', len(names) - sum(dir_tf) * (ftype != 'dir'))
+        # if dir, yield names matching expr
+        if ftype == 'dir' and multi:
+            for name in names:
+                idx = _match_each(expr, pattern, name)
+                if len(idx) > 0:
+                    yield idx, os.path.join(folder,name)
+        elif ftype == 'dir':
+            for name in names:
+                if match(name):
+                    yield os.path.join(folder,name)
+        else: # yield files matching ftype
+            for name, is_dir in zip(names, dir_tf):
+                if not is_dir and match(name):
+                    if verbose:
+                        print('Searching {name}'.format(name=name))
+                    yield os.path.join(folder,name)
+        # search additional levels (in order, depth-first)
+        if n_levels > 0:
+            subdirs = [name for name, is_dir in zip(names, dir_tf) if is_dir]
+            for name in reversed(subdirs):
+                stack.append((os.path.join(folder,name), n_levels-1))
+
+def _is_binary(filename, n_bytes=8192):
+    ''' return True if the first n_bytes of filename contain a null byte '''
+    with open(filename, 'rb') as f:
+        return b'\0' in f.read(n_bytes)
+
+def _search_file(args):
+    ''' return filename if text in file contains expr, otherwise None (or, if
+        expr is a list, return indices of expressions found in text)
+    '''
+    filename, expr, scan, max_size, skip_binary = args
+    multi = type(expr) == list
+    # skip large or binary files
+    if max_size != None and os.path.getsize(filename) > max_size:
+        return None
+    if skip_binary and _is_binary(filename):
+        return None
+    # read entire file
+    if scan == 'read':
+        with open(filename, 'r') as f:
+            txt = f.read()
+        n_bytes = len(txt)
+        if multi:
+            fnd = _search_each(expr, txt)
+        else:
+            fnd = compile_pattern(expr).search(txt) != None
+    else: # search bytes without reading entire file
+        if multi:
+            expr = [_as_bytes(e) for e in expr]
+        else:
+            expr = compile_pattern(_as_bytes(expr))
+        with open(filename, 'rb') as f:
+            if scan == 'mmap':
+                n_bytes = os.fstat(f.fileno()).st_size
+                if n_bytes == 0:
+                    m = b''
+                else:
+                    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    if multi:
+                        fnd = _search_each(expr, m)
+                    else:
+                        fnd = expr.search(m) != None
+                finally:
+                    if n_bytes > 0:
+                        m.close()
+            else: # search overlapping chunks until found
+                buf = f.read(_CHUNK_SIZE)
+                n_bytes = len(buf)
+                pos = 0
+                if multi:
+                    fnd = []
+                    idx = set(range(len(expr)))
+                while True:
+                    if multi:
+                        fnd = sorted(fnd + _search_each(expr, buf, sorted(
+                            idx.difference(fnd)), pos))
+                        done = len(fnd) == len(expr)
+                    else:
+                        fnd = expr.search(buf, pos) != None
+                        done = fnd
+                    chunk = f.read(_CHUNK_SIZE)
+                    n_bytes += len(chunk)
+                    if done or len(chunk) == 0:
+                        break
+                    # keep one byte before overlap so that the overlap is not
+                    # matched as the start of the file (e.g., by '^')
+                    buf = buf[-(_CHUNK_OVERLAP + 1):] + chunk
+                    pos = 1
+    if _stats != None:
+        _count('files_read')
+        _count('bytes_read', n_bytes)
+        _count('regex')
+    if multi:
+        return fnd
+    elif fnd:
+        return filename
+    return None
+
+def _pattern_key(expr):
+    ''' return json serializable key for expression(s) in expr '''
+    if type(expr) == list:
+        return [_pattern_key(e) for e in expr]
+    if isinstance(expr, _pattern_type):
+        return [_pattern_key(expr.pattern), expr.flags]
+    if isinstance(expr, bytes) and not isinstance(expr, str):
+        return expr.decode('utf-8', 'replace')
+    return expr
+
+def _search_tasks(files, expr, scan, max_size, skip_binary, cache=None,
+                  key=None):
+    ''' yield search task for each file with cached result (or None) '''
+    for f in files:
+        if cache != None:
+            st = _stat_key(f)
+            fnd = cache.get_match(f, st, key)
+        else:
+            st = None
+            fnd = None
+        yield f, expr, scan, max_size, skip_binary, st, fnd
+
+def _search_task(task):
+    ''' return (filename, found, stat, searched) for a search task, searching
+        file text only if there is no cached result (found is a list of
+        indices of expressions found if expr is a list)
+    '''
+    filename, expr, scan, max_size, skip_binary, st, fnd = task
+    if fnd != None:
+        return filename, fnd, st, False
+    fnd = _search_file((filename, expr, scan, max_size, skip_binary))
+    if type(expr) == list:
+        fnd = fnd or []
+    else:
+        fnd = fnd != None
+    return filename, fnd, st, True
+
+def iter_search(folder, expr, ftype, n_levels=np.inf, verbose=False,
+                n_jobs=1, use_processes=False, scan='read', max_size=None,
+                skip_binary=False, cache=None):
+    ''' search a folder, subfolders, and files for expr and yield matches as
+        they are found
+
+        Parameters:
+        folder - str, folder to begin search
+        expr - str, compiled pattern, or list, expression(s) to search within
+            folders/files (a list of expressions is searched in a single walk)
+        ftype - str or compiled pattern, file type to narrow search (or 'dir'
+            to search folders)
+        n_levels - int, number of directory levels to search
+            [default is np.inf]
+        verbose - bool, print folder/file currrently being searched
+            [default is False]
+        n_jobs - int, number of workers used to search file text (-1 uses
+            one worker per cpu)
+            [default is 1]
+        use_processes - bool, search file text using a process pool rather
+            than a thread pool
+            [default is False]
+        scan - str, method used to search file text: 'read' to read each file
+            entirely, 'mmap' to search a memory map of each file, or 'chunk' to
+            search overlapping chunks of each file (matches longer than 4 KB
+            that span chunks may be missed). 'mmap' and 'chunk' search bytes
+            and stop at the first match.
+            [default is 'read']
+        max_size - int, skip files larger than max_size bytes
+            [default is None]
+        skip_binary - bool, skip files containing a null byte within the first
+            8 KB
+            [default is False]
+        cache - SearchCache or str, cache (or json filename of cache, which is
+            saved after searching) used to skip listing unchanged directories
+            and searching unchanged files
+            [default is None]
+
+        Returns:
+        generator, yields fullpath files that contained expression in name or
+            text (in the same order as pebl_search), or (expression, file) for
+            each expression found if expr is a list
+
+        Example:
+        folder = os.curdir
+        expr = 'def pebl_search'
+        ftype = '.*\.py$'
+        for filename in iter_search(folder, expr, ftype, n_jobs=-1):
+            print(filename)
+        /pebl/pebl/functions/utils.py
+    '''
+    if scan not in ('read', 'mmap', 'chunk'):
+        raise ValueError('unknown scan: {scan}'.format(scan=scan))
+    if type(expr) == tuple:
+        expr = list(expr)
+    # load cache from filename
+    cache_file = None
+    if isinstance(cache, str):
+        cache_file = cache
+        cache = SearchCache(cache_file)
+    try:
+        multi = type(expr) == list
+        files = _walk_search(folder, expr, ftype, n_levels, verbose, cache)
+        # if dir, names have already been matched
+        if ftype == 'dir' and multi:
+            for idx, filename in files:
+                for n in idx:
+                    yield expr[n], filename
+            return
+        elif ftype == 'dir':
+            for filename in files:
+                yield filename
+            return
+        # get cached results for files
+        key = json.dumps([_pattern_key(expr), scan, max_size, skip_binary])
+        tasks = _search_tasks(files, expr, scan, max_size, skip_binary, cache,
+            key)
+        # search text of each file
+        if n_jobs == -1:
+            n_jobs = multiprocessing.cpu_count()
+        if n_jobs > 1:
+            if use_processes:
+                pool = multiprocessing.Pool(n_jobs)
+            else:
+                pool = ThreadPool(n_jobs)
+            results = pool.imap(_search_task, tasks, chunksize=8)
+        else:
+            pool = None
+            results = (_search_task(t) for t in tasks)
+        try:
+            for filename, fnd, st, searched in results:
+                if cache != None:
+                    if searched:
+                        cache.counts['file_misses'] += 1
+                        cache.set_match(filename, st, key, fnd)
+                    else:
+                        cache.counts['file_hits'] += 1
+                if multi:
+                    for n in fnd:
+                        yield expr[n], filename
+                elif fnd:
+                    yield filename
+        finally:
+            if pool != None:
+                pool.terminate()
+    finally:
+        if cache_file != None:
+            cache.save()
+
+def pebl_search(folder, expr, ftype, n_levels=np.inf, verbose=False, n_jobs=1,
+                use_processes=False, scan='read', max_size=None,
+                skip_binary=False, cache=None, group=False,
+                return_type='list'):
     ''' search a folder, subfolders, and files for expr
 
         Parameters:
         folder - str, folder to begin search
-        expr - str, expression to search within folders/files
-        ftype - str, file type to narrow search (or 'dir' to search folders)
+        expr - str, compiled pattern, or list, expression(s) to search within
+            folders/files (a list of expressions is searched in a single walk)
+        ftype - str or compiled pattern, file type to narrow search (or 'dir'
+            to search folders)
         n_levels - int, number of directory levels to search
             [default is np.inf]
         verbose - bool, print folder/file currrently being searched
             [default is False]
+        n_jobs - int, number of workers used to search file text (-1 uses
+            one worker per cpu)
+            [default is 1]
+        use_processes - bool, search file text using a process pool rather
+            than a thread pool
+            [default is False]
+        scan - str, method used to search file text: 'read' to read each file
+            entirely, 'mmap' to search a memory map of each file, or 'chunk' to
+            search overlapping chunks of each file (matches longer than 4 KB
+            that span chunks may be missed). 'mmap' and 'chunk' search bytes
+            and stop at the first match.
+            [default is 'read']
+        max_size - int, skip files larger than max_size bytes
+            [default is None]
+        skip_binary - bool, skip files containing a null byte within the first
+            8 KB
+            [default is False]
+        cache - SearchCache or str, cache (or json filename of cache, which is
+            saved after searching) used to skip listing unchanged directories
+            and searching unchanged files
+            [default is None]
+        group - bool, return dict of files found for each expression in expr
+            [default is False]
+        return_type - str, 'list' to return files as a list or 'array' to
+            return a 1-d object array
+            [default is 'list']
 
         Returns:
         files - list, fullpath files that contained expression in name or text
+            (any expression if expr is a list), or dict of expression: list if
+            group is True
 
         Example 1:
         folder = os.curdir
@@ -601,40 +2935,475 @@ def pebl_search(folder, expr, ftype, n_levels=np.inf, verbose=False):
         files = pebl_search(folder, expr, ftype)
         files =
         ['/pebl/pebl/functions/utils.py']
+
+        Example 3:
+        folder = '/study/sub01'
+        expr = ['.*\.nii$', 'rp_.*\.txt$', '.*\.mat$']
+        files = pebl_search(folder, expr, 'dir', group=True)
+        files =
+        {'.*\.nii$': ['/study/sub01/anat.nii', '/study/sub01/func.nii'],
+        'rp_.*\.txt$': ['/study/sub01/rp_func.txt'],
+        '.*\.mat$': ['/study/sub01/batch.mat']}
+
+        Note: See iter_search for a generator version.
     '''
-    # init files output
-    files = np.array([])
-    # set folder to fullpath
-    folder = os.path.abspath(folder)
-    # get names of files/folders in folder
-    names = os.listdir(folder)
-    # get indices of directories
-    dir_tf = np.array([os.path.isdir(os.path.join(folder,n)) for n in names],
-        dtype=np.bool)
-    # regex for ftype matches
-    matches = [re.match(ftype, n) for n in names]
-    ftype_tf = np.array([m != None for m in matches], dtype=np.bool)
-    # find files to search
-    file_tf = np.invert(dir_tf) * ftype_tf
-    # if dir, search files for expr
-    if ftype == 'dir':
-        fnd = np.array([re.match(expr, n) != None for n in names], dtype=np.bool)
-        for i in np.where(fnd)[0]:
-            files = np.append(files, os.path.join(folder,names[i]))
-    else: # for each file, search text for expr
-        for i in np.where(file_tf)[0]:
-            if verbose:
-                print('Searching {name}'.format(name=names[i]))
-            with open(os.path.join(folder,names[i]), 'r') as f:
-                txt = f.read()
-            if len(re.findall(expr, txt)) > 0:
-                files = np.append(files, os.path.join(folder,names[i]))
-    # search additional levels
-    if n_levels > 0 and np.any(dir_tf):
-        for i in np.where(dir_tf)[0]:
-            if verbose:
-                print('Searching {dir}'.format(dir=names[i]))
-            files = np.append(files, pebl_search(os.path.join(folder,names[i]),
-                expr, ftype, n_levels=n_levels-1, verbose=verbose))
-    # return files as list
-    return files.tolist()
+    files = iter_search(folder, expr, ftype, n_levels, verbose, n_jobs,
+        use_processes, scan, max_size, skip_binary, cache)
+    if type(expr) not in (list, tuple):
+        if group:
+            return {expr: _return_type(list(files), return_type)}
+        return _return_type(list(files), return_type)
+    # group files by expression
+    if group:
+        out = dict([(e, []) for e in expr])
+        for e, filename in files:
+            out[e].append(filename)
+        return dict([(e, _return_type(out[e], return_type)) for e in out])
+    # return files matching any expression
+    out = []
+    found = set()
+    for _, filename in files:
+        if filename not in found:
+            found.add(filename)
+            out.append(filename)
+    return _return_type(out, return_type)
+
+def _text_token(value):
+    ''' return token for str/unicode value '''
+    if isinstance(value, bytes):
+        return b's' + value
+    return b's' + value.encode('utf-8')
+
+def _repr_token(value):
+    ''' return token for number, bool, or None value '''
+    return type(value).__name__.encode('utf-8') + b':' + \
+        repr(value).encode('utf-8')
+
+# tokens of common leaf types (see _hash_value)
+_leaf_tokens = {str: _text_token, type(u''): _text_token,
+                int: _repr_token, float: _repr_token, bool: _repr_token,
+                complex: _repr_token, type(None): _repr_token}
+if sys.version_info[0] == 2:
+    _leaf_tokens[long] = _repr_token
+
+def _hash_token(value, cache):
+    ''' return token (bytes) for value: leaves are encoded directly and other
+        values are hashed (see _hash_value)
+    '''
+    t = type(value)
+    if t == str or t == type(u'') or t == int:
+        # reuse tokens of repeated strings (e.g., field names) and ints
+        key = (t, value)
+        token = cache.get(key)
+        if token == None:
+            token = _leaf_tokens[t](value)
+            token = cache[key] = str(len(token)).encode('utf-8') + token
+        return token
+    elif t in _leaf_tokens:
+        token = _leaf_tokens[t](value)
+    else:
+        token = _hash_value(value, cache)
+    # prefix length so that joined tokens are unambiguous
+    return str(len(token)).encode('utf-8') + token
+
+def _hash_value(value, cache):
+    ''' return sha1 digest (bytes) of value, using cache of container ids
+        (see pebl_hash)
+    '''
+    # use cached digest of container
+    is_container = isinstance(value, (dict, list, tuple, np.ndarray))
+    if is_container and id(value) in cache:
+        return cache[id(value)][1]
+    buf = None
+    if type(value) == dict:
+        # dicts are equal regardless of key order
+        tokens = sorted([_hash_token(k, cache) + _hash_token(v, cache)
+                         for k, v in value.items()])
+        data = [b'dict'] + tokens
+    elif type(value) in (list, tuple):
+        data = [type(value).__name__.encode('utf-8')]
+        data.extend([_hash_token(v, cache) for v in value])
+    elif type(value) in (set, frozenset):
+        # sets are equal regardless of order
+        data = [type(value).__name__.encode('utf-8')]
+        data.extend(sorted([_hash_token(v, cache) for v in value]))
+    elif isinstance(value, (np.ndarray, np.void)):
+        data = [b'ndarray' if isinstance(value, np.ndarray) else b'void',
+                value.dtype.str.encode('utf-8'),
+                str(np.shape(value)).encode('utf-8')]
+        # hash objects/fields by value and other data by buffer
+        if value.dtype.names != None:
+            data.append(str(value.dtype.names).encode('utf-8'))
+            for idx in np.ndindex(np.shape(value)):
+                data.extend([_hash_token(value[idx][name], cache)
+                             for name in value.dtype.names])
+        elif value.dtype == np.object:
+            data.extend([_hash_token(v, cache) for v in value.flat])
+        else:
+            # hash buffer without copying (unless not contiguous)
+            buf = memoryview(np.ascontiguousarray(value).reshape(-1).view(
+                np.uint8))
+    elif isinstance(value, np.generic):
+        data = [value.dtype.str.encode('utf-8'), value.tobytes()]
+    elif type(value) in _leaf_tokens:
+        data = [_leaf_tokens[type(value)](value)]
+    else: # other object, hashed by content when pickled
+        try:
+            data = [b'pickle', pickle.dumps(value, 2)]
+        except Exception:
+            raise TypeError('cannot fingerprint {name} object'.format(
+                name=type(value).__name__))
+    h = hashlib.sha1(b'\0'.join(data))
+    if buf != None:
+        h.update(b'\0')
+        h.update(buf)
+    digest = b'h' + h.digest()
+    # keep reference to value so that its id is not reused
+    if is_container:
+        cache[id(value)] = (value, digest)
+    return digest
+
+def pebl_hash(A, cache=None):
+    ''' return stable fingerprint of the structure and values of A
+
+        Parameters:
+        A - object, object to fingerprint (dicts, lists, tuples, sets,
+            ndarrays, np.void, strings, numbers, and other objects that can be
+            pickled)
+        cache - dict, cache of digests for containers by id (and of repeated
+            string tokens) that may be reused between calls if the containers
+            are not modified (e.g., the shared containers of PersistentStruct
+            versions)
+            [default is None]
+
+        Returns:
+        fingerprint - str, hex digest identical for equal values of A (across
+            runs and regardless of dict key order)
+
+        Example:
+        pebl_hash({'a': [1, 2], 'b': np.arange(3)})
+        '2e3e10de74b0557e4bd16b1f29dbe39a5f1becf9'
+        pebl_hash({'b': np.arange(3), 'a': [1, 2]}) == _
+        True
+
+        Note: Numeric ndarrays are hashed by buffer. Other objects are hashed
+        by their pickled content (which may differ between runs if the object
+        contains sets or dicts built in a different order), and a TypeError is
+        raised for objects that cannot be pickled.
+    '''
+    if isinstance(A, PersistentStruct):
+        A = A.A
+    if cache == None:
+        cache = {}
+    return binascii.hexlify(_hash_value(A, cache)[1:]).decode('ascii')
+
+class MemoStore(object):
+    ''' least recently used store of results by fingerprint, kept in memory
+        or in a folder (see pebl_memoize)
+
+        Parameters:
+        max_bytes - int, maximum total size of stored results (as pickled)
+            [default is 64 MB]
+        folder - str, folder to store results in (so that results are reused
+            between runs)
+            [default is None, results are kept in memory]
+
+        Attributes:
+        entries - OrderedDict, fingerprint: pickled result (if folder is None)
+        n_bytes - int, total size of results kept in memory
+        counts - dict, number of hits and misses
+
+        Note: Results stored in a folder are pickle files, so only use folders
+        that are not writable by others.
+    '''
+    def __init__(self, max_bytes=64 << 20, folder=None):
+        self.max_bytes = max_bytes
+        self.folder = folder
+        self.entries = collections.OrderedDict()
+        self.n_bytes = 0
+        self._lock = threading.Lock()
+        self.counts = {'hits': 0, 'misses': 0}
+        if folder != None and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def get(self, key):
+        ''' return (True, result) for fingerprint key, or (False, None) '''
+        with self._lock:
+            if self.folder == None:
+                data = self.entries.pop(key, None)
+                if data != None:
+                    self.entries[key] = data
+            else:
+                filename = os.path.join(self.folder, key + '.pkl')
+                try:
+                    with open(filename, 'rb') as f:
+                        data = f.read()
+                    os.utime(filename, None)
+                except (IOError, OSError):
+                    data = None
+            if data == None:
+                self.counts['misses'] += 1
+                return False, None
+            self.counts['hits'] += 1
+        return True, pickle.loads(data)
+
+    def set(self, key, result):
+        ''' store result for fingerprint key, evicting least recently used
+            results beyond max_bytes
+        '''
+        data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if self.folder == None:
+                old = self.entries.pop(key, None)
+                if old != None:
+                    self.n_bytes -= len(old)
+                self.entries[key] = data
+                self.n_bytes += len(data)
+                while self.n_bytes > self.max_bytes:
+                    _, old = self.entries.popitem(last=False)
+                    self.n_bytes -= len(old)
+                return
+            # write to temporary file, then replace
+            filename = os.path.join(self.folder, key + '.pkl')
+            with open(filename + '.tmp', 'wb') as f:
+                f.write(data)
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.rename(filename + '.tmp', filename)
+            # remove least recently used files
+            files = [os.path.join(self.folder, f)
+                     for f in os.listdir(self.folder) if f.endswith('.pkl')]
+            files = sorted([(os.path.getmtime(f), os.path.getsize(f), f)
+                            for f in files])
+            n_bytes = sum([n for _, n, _ in files])
+            for _, n, f in files:
+                if n_bytes <= self.max_bytes:
+                    break
+                os.remove(f)
+                n_bytes -= n
+
+    def clear(self):
+        ''' remove all stored results '''
+        with self._lock:
+            self.entries.clear()
+            self.n_bytes = 0
+            if self.folder != None:
+                for f in os.listdir(self.folder):
+                    if f.endswith('.pkl'):
+                        os.remove(os.path.join(self.folder, f))
+
+def pebl_memoize(store=None, max_bytes=64 << 20, folder=None):
+    ''' return decorator that skips calls whose arguments have the same
+        fingerprint as a previous call (see pebl_hash), returning the stored
+        result instead
+
+        Parameters:
+        store - MemoStore, store of results
+            [default is None, creates MemoStore(max_bytes, folder)]
+        max_bytes - int, maximum total size of stored results
+            [default is 64 MB]
+        folder - str, folder to store results between runs
+            [default is None]
+
+        Returns:
+        decorator - function, decorator for pipeline step functions (the
+            decorated function has a store attribute)
+
+        Example:
+        @pebl_memoize(folder='/study/.memo')
+        def realign(batch):
+            ...
+            return results
+        results = realign(batch) # runs realign
+        results = realign(batch) # returns stored results
+
+        Note: Only the function name and arguments are fingerprinted, so clear
+        the store if the function or files it reads change.
+    '''
+    if store == None:
+        store = MemoStore(max_bytes, folder)
+    def decorator(fun):
+        @functools.wraps(fun)
+        def wrapper(*args, **kwargs):
+            key = pebl_hash([fun.__module__, fun.__name__, list(args),
+                kwargs])
+            found, result = store.get(key)
+            if found:
+                return result
+            result = fun(*args, **kwargs)
+            store.set(key, result)
+            return result
+        wrapper.store = store
+        return wrapper
+    return decorator
+
+# functions timed while profiling is enabled
+_PROFILED = ['cell2strtable', 'write_strtable', 'py2mat', '_py2mat_value',
+             'subsref', 'subsasgn', '_set_paths', 'sub2str', 'struct2sub',
+             'pebl_getfield', 'pebl_setfield', '_fun_mask', '_list_dir',
+             '_search_file', 'pebl_search']
+
+def _count(key, n=1):
+    ''' add n to profiling count for key '''
+    with _stats_lock:
+        _stats['counts'][key] = _stats['counts'].get(key, 0) + n
+
+def _profiled(fun):
+    ''' return wrapper of fun that records calls and time (only the
+        outermost call of a recursive function is timed)
+    '''
+    name = fun.__name__
+    local = threading.local()
+    @functools.wraps(fun)
+    def wrapper(*args, **kwargs):
+        depth = getattr(local, 'depth', 0)
+        local.depth = depth + 1
+        t0 = time.time()
+        try:
+            return fun(*args, **kwargs)
+        finally:
+            local.depth = depth
+            stats = _stats
+            if stats != None:
+                with _stats_lock:
+                    stats['calls'][name] = stats['calls'].get(name, 0) + 1
+                    if depth == 0:
+                        stats['time'][name] = stats['time'].get(name, 0.) + \
+                            time.time() - t0
+    wrapper._profiled = fun
+    return wrapper
+
+class _ProfileCopy(object):
+    ''' stand-in for the copy module that counts deepcopy calls and bytes
+        (the sys.getsizeof of each object copied) while profiling
+    '''
+    copy = staticmethod(copy.copy)
+    def deepcopy(self, x, memo=None):
+        if memo == None:
+            memo = {}
+        y = _copy_module.deepcopy(x, memo)
+        if _stats != None:
+            _count('deepcopy')
+            _count('deepcopy_bytes', sum([sys.getsizeof(v)
+                for k, v in memo.items() if k != id(memo)]))
+        return y
+
+_copy_module = copy
+
+def _enable_profile():
+    ''' start recording profiling stats, returning stats dict '''
+    global _stats, copy
+    if _stats != None:
+        return _stats
+    _stats = {'calls': {}, 'time': {}, 'counts': {}}
+    # replace functions with timed wrappers and copy with counting copy
+    g = globals()
+    for name in _PROFILED:
+        g[name] = _profiled(g[name])
+    copy = _ProfileCopy()
+    return _stats
+
+def _disable_profile():
+    ''' stop recording profiling stats, returning stats dict '''
+    global _stats, copy
+    stats = _stats
+    g = globals()
+    for name in _PROFILED:
+        g[name] = getattr(g[name], '_profiled', g[name])
+    copy = _copy_module
+    _stats = None
+    return stats
+
+def profile_summary(stats, as_json=False):
+    ''' return summary of profiling stats as a table or json
+
+        Parameters:
+        stats - dict, profiling stats (see profile)
+        as_json - bool, return json string rather than table
+            [default is False]
+
+        Returns:
+        summary - str, table of calls and time for each function followed by
+            each count (rendered with cell2strtable) or json of stats
+    '''
+    if as_json:
+        return json.dumps(stats, indent=2, sort_keys=True)
+    # sort functions by time
+    names = sorted(stats['calls'].keys(), key=lambda x:
+        -stats['time'].get(x, 0.))
+    table = [['function', 'calls', 'time (s)']]
+    for name in names:
+        table.append([name, stats['calls'][name],
+            '%.6f' % stats['time'].get(name, 0.)])
+    counts = [['count', 'value']]
+    for key in sorted(stats['counts'].keys()):
+        counts.append([key, stats['counts'][key]])
+    return cell2strtable(table) + '\n\n' + cell2strtable(counts)
+
+class profile(object):
+    ''' context manager to record calls, time, and counts for utils functions
+
+        Parameters:
+        filename - str, json file to save stats when exiting
+            [default is None]
+        verbose - bool, print summary table when exiting
+            [default is False]
+
+        Attributes:
+        stats - dict, 'calls' (function: number of calls), 'time' (function:
+            total seconds of outermost calls), and 'counts' (deepcopy,
+            deepcopy_bytes, dirs_listed, files_listed, files_read, bytes_read,
+            and regex evaluations)
+
+        Example:
+        with profile() as p:
+            C, S, R = pebl_getfield(A, expr='.*\["data"]')
+        print(profile_summary(p.stats))
+        function         calls    time (s)
+        pebl_getfield    1        0.012013
+        struct2sub       1        0.008021
+        ...
+
+        Note: Profiling may also be enabled for the whole session by setting
+        the environment variable PEBL_PROFILE (to a json filename to save stats
+        or to any other value to print the summary table at exit). Functions
+        are only wrapped while profiling, so there is no cost otherwise.
+        Counts from files searched in other processes (use_processes=True)
+        are not recorded. Nested profile contexts share stats.
+    '''
+    def __init__(self, filename=None, verbose=False):
+        self.filename = filename
+        self.verbose = verbose
+        self.stats = None
+        self._nested = False
+
+    def __enter__(self):
+        self._nested = _stats != None
+        self.stats = _enable_profile()
+        return self
+
+    def __exit__(self, *args):
+        if not self._nested:
+            _disable_profile()
+        if self.filename != None:
+            with open(self.filename, 'w') as f:
+                f.write(profile_summary(self.stats, True))
+        if self.verbose:
+            print(profile_summary(self.stats))
+        return False
+
+def _profile_atexit(value):
+    ''' save or print stats recorded using PEBL_PROFILE '''
+    stats = _disable_profile()
+    if value.endswith('.json'):
+        with open(value, 'w') as f:
+            f.write(profile_summary(stats, True))
+    else:
+        sys.stderr.write(profile_summary(stats) + '\n')
+
+# enable profiling for session using environment variable
+if os.environ.get('PEBL_PROFILE'):
+    _enable_profile()
+    atexit.register(_profile_atexit, os.environ['PEBL_PROFILE'])